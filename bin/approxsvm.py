@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+"""
+Approximate-kernel SVM for fast local prediction.
+
+The exact RBF SVM (gamma=100, cost=100, as ee.Classifier.libsvm in
+process.py) costs pixels x support vectors kernel evaluations to predict. In
+the approximate mode the features are mapped with a Nystroem or random
+Fourier feature transform of the same RBF kernel and classified by a linear
+SVM, so predicting a chunk of pixels is one small matrix multiply. The
+agreement with the exact classifier on the validation split tells how much
+accuracy is given up for the speed.
+"""
+
+import time
+import numpy as np
+from metrics import confusionMatrix,accuracies
+
+
+# =============================================================================
+# Function to train the approximate classifier.
+
+## Usage:
+# features = array (points x bands), e.g. from validation.featureTable.
+# labels = int array of classes.
+# gamma, cost = SVM parameters (as the exact RBF SVM).
+# method = 'nystroem' or 'fourier' (random Fourier features).
+# components = dimension of the approximate feature space.
+# seed = random seed of the transform.
+
+## Output:
+# fitted sklearn Pipeline (transform -> linear SVM) with predict().
+# =============================================================================
+def fitApproximate(features, labels, gamma=100, cost=100, method='nystroem', components=500, seed=0):
+    from sklearn.pipeline import make_pipeline
+    from sklearn.svm import LinearSVC
+    from sklearn.kernel_approximation import Nystroem,RBFSampler
+
+    features = np.asarray(features, dtype=np.float32)
+    if method == 'nystroem':
+        ## Landmarks are training points, so more components than points is useless
+        transform = Nystroem(kernel='rbf', gamma=gamma, n_components=min(components, len(features)),
+                             random_state=seed)
+    elif method == 'fourier':
+        transform = RBFSampler(gamma=gamma, n_components=components, random_state=seed)
+    else:
+        raise ValueError('Unknown approximation: '+str(method))
+
+    model = make_pipeline(transform, LinearSVC(C=cost, max_iter=20000))
+    model.fit(features, np.asarray(labels, dtype=int))
+    return model
+
+###############################################################################
+
+
+# =============================================================================
+# Function to predict by chunks.
+
+## Usage:
+# model = fitted classifier (exact SVC or fitApproximate).
+# features = array (pixels x bands).
+# chunk = pixels predicted at a time.
+
+## Output:
+# uint8 array (pixels) of classes.
+# =============================================================================
+def predict(model, features, chunk=262144):
+    features = np.asarray(features, dtype=np.float32)
+    classes = np.empty(len(features), dtype=np.uint8)
+    for start in range(0, len(features), chunk):
+        classes[start:start + chunk] = model.predict(features[start:start + chunk])
+    return classes
+
+###############################################################################
+
+
+# =============================================================================
+# Function to compare the approximate and exact classifiers.
+
+## Usage:
+# features, labels = sampled table (all points).
+# train = optional bool array, True for the training points (default: local
+#         random 70/30 split with seed; it does not reproduce randomColumn in
+#         process.py).
+# gamma, cost, method, components = as in fitApproximate.
+# seed = random seed of the split and of the transform.
+
+## Output:
+# dictionary with the exact and approximate models ('exact', 'approximate'),
+# 'agreement' (fraction of validation points with the same prediction),
+# 'accuracy' and 'kappa' of both on the validation points ((exact, approximate)),
+# 'support' (support vectors of the exact SVM) and the prediction time per
+# point in seconds of both ('seconds', (exact, approximate)).
+# =============================================================================
+def compareApproximate(features, labels, train=None, gamma=100, cost=100, method='nystroem',
+                       components=500, nClasses=4, seed=0):
+    from sklearn.svm import SVC
+
+    features = np.asarray(features, dtype=np.float32)
+    labels = np.asarray(labels, dtype=int)
+    if train is None:
+        train = np.random.default_rng(seed).random(len(labels)) < 0.7
+    valid = ~train
+
+    exact = SVC(kernel='rbf', gamma=gamma, C=cost).fit(features[train], labels[train])
+    approximate = fitApproximate(features[train], labels[train], gamma, cost, method, components, seed)
+
+    predictions, seconds = [], []
+    for model in (exact, approximate):
+        start = time.perf_counter()
+        predictions.append(predict(model, features[valid]))
+        seconds.append((time.perf_counter() - start) / max(valid.sum(), 1))
+
+    scores = accuracies(np.stack([confusionMatrix(labels[valid], p, nClasses) for p in predictions]))
+    return {'exact': exact, 'approximate': approximate,
+            'agreement': float((predictions[0] == predictions[1]).mean()) if valid.any() else None,
+            'accuracy': tuple(float(v) for v in scores['accuracy']),
+            'kappa': tuple(float(v) for v in scores['kappa']),
+            'support': int(exact.support_.size), 'seconds': tuple(seconds)}
+
+###############################################################################
@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+"""
+Compiled band-math expressions for local processing.
+
+Expressions written as in functions.rescale (e.g. 'img.B4 + img.B3 + img.B2')
+are parsed once, cached, and turned into a short list of NumPy ufunc calls.
+They run chunk by chunk with in-place operations on preallocated buffers
+and write straight into the output array, with the linear rescale of
+rescale/rescaleThr fused into the same pass. Integer DN bands (scaling.py)
+are scaled to float32 window by window as they are read. Callers running
+several programs on the same scene pass a workspace, so the buffers are
+allocated once.
+"""
+
+import ast
+import functools
+import collections
+import numpy as np
+from scaling import scaled
+
+_BINARY = {ast.Add: np.add, ast.Sub: np.subtract, ast.Mult: np.multiply,
+           ast.Div: np.divide, ast.Pow: np.power}
+
+## bands = band names read by the expression; code = list of (ufunc, destination,
+## operands); registers = number of chunk buffers needed.
+## Operands are ('band', name), ('const', value), ('reg', i) or ('out', None).
+Program = collections.namedtuple('Program', ['expression', 'bands', 'code', 'registers'])
+
+
+class _Compiler:
+    def __init__(self):
+        self.code = []
+        self.bands = []
+        self.registers = 0
+        self.free = []
+
+    def register(self):
+        if self.free:
+            return ('reg', self.free.pop())
+        self.registers += 1
+        return ('reg', self.registers - 1)
+
+    def release(self, operand):
+        if operand[0] == 'reg':
+            self.free.append(operand[1])
+
+    def visit(self, node):
+        if isinstance(node, ast.Expression):
+            return self.visit(node.body)
+        if isinstance(node, ast.Constant) and isinstance(node.value, (int, float)):
+            return ('const', float(node.value))
+        if isinstance(node, ast.Attribute) and isinstance(node.value, ast.Name) and node.value.id == 'img':
+            if node.attr not in self.bands:
+                self.bands.append(node.attr)
+            return ('band', node.attr)
+        if isinstance(node, ast.Name) and node.id == 'img':
+            ## Single band image, e.g. rescale(ndsi, 'img', ...)
+            if 'img' not in self.bands:
+                self.bands.append('img')
+            return ('band', 'img')
+        if isinstance(node, ast.UnaryOp) and isinstance(node.op, (ast.USub, ast.UAdd)):
+            operand = self.visit(node.operand)
+            if isinstance(node.op, ast.UAdd):
+                return operand
+            if operand[0] == 'const':
+                return ('const', -operand[1])
+            self.release(operand)
+            dst = self.register()
+            self.code.append((np.negative, dst, (operand,)))
+            return dst
+        if isinstance(node, ast.BinOp) and type(node.op) in _BINARY:
+            ufunc = _BINARY[type(node.op)]
+            left = self.visit(node.left)
+            right = self.visit(node.right)
+            if left[0] == 'const' and right[0] == 'const':
+                return ('const', float(ufunc(left[1], right[1])))
+            ## Reuse the buffer of an intermediate result (in-place operation)
+            self.release(right)
+            self.release(left)
+            dst = self.register()
+            self.code.append((ufunc, dst, (left, right)))
+            return dst
+        raise ValueError('Unsupported band math: '+ast.dump(node))
+
+
+# =============================================================================
+# Function to compile a band-math expression (cached).
+
+## Usage:
+# expression = str, e.g. 'img.B4 + img.B3 + img.B2', bands as img.<name>.
+# rescale = optional (thresholds, mode) fused at the end of the expression:
+#           mode 'rescale':    (x - t0) / (t1 - t0), as functions.rescale
+#           mode 'rescaleThr': (x + t0) / (t1 + t0), as functions.rescaleThr
+
+## Output:
+# Program, to run with evaluate.
+# =============================================================================
+@functools.lru_cache(maxsize=None)
+def compileExpression(expression, rescale=None):
+    compiler = _Compiler()
+    result = compiler.visit(ast.parse(expression.strip(), mode='eval'))
+
+    ## The buffer holding the result is replaced by the output array, so
+    ## the last operation writes straight into it.
+    if result[0] != 'reg':
+        operand, result = result, compiler.register()
+        compiler.code.append((np.add, result, (operand, ('const', 0.0))))
+    rename = lambda operand: ('out', None) if operand == result else operand
+    code = [(ufunc, rename(dst), tuple(rename(a) for a in args))
+            for ufunc, dst, args in compiler.code]
+
+    if rescale is not None:
+        thresholds, mode = rescale
+        t0, t1 = float(thresholds[0]), float(thresholds[1])
+        if mode == 'rescale':
+            shift, scale = -t0, 1.0 / (t1 - t0)
+        else:
+            shift, scale = t0, 1.0 / (t1 + t0)
+        code.append((np.add, ('out', None), (('out', None), ('const', shift))))
+        code.append((np.multiply, ('out', None), (('out', None), ('const', scale))))
+
+    return Program(expression, tuple(compiler.bands), tuple(code), compiler.registers)
+
+###############################################################################
+
+
+## Float32 buffer of a workspace with at least shape[0] rows, (re)allocated
+## only when missing or too small
+def _buffer(workspace, key, shape):
+    buffer = workspace.get(key)
+    if buffer is None or buffer.shape[0] < shape[0] or buffer.shape[1] != shape[1]:
+        buffer = workspace[key] = np.empty(shape, dtype=np.float32)
+    return buffer
+
+
+# =============================================================================
+# Function to evaluate a compiled expression.
+
+## Usage:
+# program = from compileExpression.
+# bands = dictionary band name -> array (rows x cols), or a single array for 'img'.
+# out = optional float32 output array (rows x cols).
+# chunkRows = rows computed at a time (buffers are chunkRows x cols).
+# scales = optional dictionary band name -> (scale, offset) of DN bands
+#          (see scaling.scaleFactors); they are scaled by window.
+# workspace = optional dictionary of buffers, filled on the first call and
+#             reused by the next ones (e.g. one per scene, for all its programs).
+
+## Output:
+# float32 array (rows x cols).
+# =============================================================================
+def evaluate(program, bands, out=None, chunkRows=256, scales=None, workspace=None):
+    if not isinstance(bands, dict):
+        bands = {'img': bands}
+    rows, cols = bands[program.bands[0]].shape if program.bands else out.shape
+    if out is None:
+        out = np.empty((rows, cols), dtype=np.float32)
+    if rows == 0:
+        return out
+    chunkRows = min(chunkRows, rows)
+    workspace = {} if workspace is None else workspace
+    buffers = [_buffer(workspace, ('reg', i), (chunkRows, cols)) for i in range(program.registers)]
+    scaledBands = {band: _buffer(workspace, ('band', band), (chunkRows, cols))
+                   for band in program.bands if scales and band in scales}
+
+    for start in range(0, rows, chunkRows):
+        stop = min(start + chunkRows, rows)
+        n = stop - start
+        for band, buffer in scaledBands.items():
+            scaled(bands[band][start:stop], *scales[band], out=buffer[:n])
+
+        def value(operand):
+            kind, key = operand
+            if kind == 'band':
+                return scaledBands[key][:n] if key in scaledBands else bands[key][start:stop]
+            if kind == 'const':
+                return key
+            if kind == 'reg':
+                return buffers[key][:n]
+            return out[start:stop]
+
+        for ufunc, dst, args in program.code:
+            ufunc(*[value(a) for a in args], out=value(dst), dtype=np.float32)
+
+    return out
+
+###############################################################################
+
+
+## Local equivalents of functions.rescale, rescaleThr and normalizedDifference.
+def rescale(bands, exp, thresholds, out=None, scales=None):
+    return evaluate(compileExpression(exp, (tuple(thresholds), 'rescale')), bands, out, scales=scales)
+
+
+def rescaleThr(bands, exp, thresholds, out=None, scales=None):
+    return evaluate(compileExpression(exp, (tuple(thresholds), 'rescaleThr')), bands, out, scales=scales)
+
+
+def normalizedDifference(bands, pair, out=None, scales=None):
+    a, b = pair
+    exp = '(img.'+a+' - img.'+b+') / (img.'+a+' + img.'+b+')'
+    return evaluate(compileExpression(exp), bands, out, scales=scales)
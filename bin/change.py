@@ -0,0 +1,218 @@
+# -*- coding: utf-8 -*-
+"""
+Multi-year change analysis of the classified maps.
+
+Every class map of a tile is appended to an on-disk time cube (time x y x,
+uint8) kept in a folder and read through np.memmap. Per-pixel statistics
+(seagrass gains and losses, persistence, first and last year seen) are kept
+next to the cube and updated incrementally when a new map is added; the
+full history is only reduced again when a map arrives out of date order.
+Reductions run on spatial chunks in parallel threads. The metadata records
+how many maps the statistics include, so an append interrupted by a crash
+is undone (extra bytes of the cube) or completed (statistics rebuilt) on
+the next use.
+"""
+
+import os
+import json
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from common import NODATA,atomicWrite
+
+## Dense (2) and sparse (3) seagrass
+SEAGRASS = (2, 3)
+
+## Per-pixel statistics: name -> (dtype, initial value)
+STATS = {'valid':    (np.uint16, 0),   # clear observations
+         'seagrass': (np.uint16, 0),   # observations with seagrass
+         'gains':    (np.uint16, 0),   # no seagrass -> seagrass
+         'losses':   (np.uint16, 0),   # seagrass -> no seagrass
+         'first':    (np.int16, -1),   # first time index with seagrass
+         'last':     (np.int16, -1),   # last time index with seagrass
+         'state':    (np.uint8, NODATA)}  # last clear observation: 1 seagrass, 0 not
+
+
+# =============================================================================
+# Function to create an empty change cube.
+
+## Usage:
+# cubeDir = folder of the cube (created if needed).
+# shape = (rows, cols) of the class maps of the tile.
+# chunk = (rows, cols) of the spatial chunks used in the reductions.
+# =============================================================================
+def createCube(cubeDir, shape, chunk=(512, 512)):
+    os.makedirs(cubeDir, exist_ok=True)
+    meta = {'shape': list(shape), 'chunk': list(chunk), 'dates': [], 'statsTimes': 0,
+            'nodata': NODATA, 'seagrass': list(SEAGRASS)}
+    open(os.path.join(cubeDir, 'cube.u8'), 'wb').close()
+    for name, (dtype, init) in STATS.items():
+        stat = np.lib.format.open_memmap(os.path.join(cubeDir, name+'.npy'), mode='w+',
+                                         dtype=dtype, shape=tuple(shape))
+        stat[:] = init
+        stat.flush()
+    _saveMeta(cubeDir, meta)
+    return meta
+
+
+def _saveMeta(cubeDir, meta):
+    def write(tmp):
+        with open(tmp, 'w') as f:
+            json.dump(meta, f, indent=1)
+    atomicWrite(os.path.join(cubeDir, 'meta.json'), write)
+
+
+## Undo or complete an append interrupted by a crash: drop the bytes of a map
+## not listed in the metadata, and rebuild statistics left partially updated.
+def _recover(cubeDir, workers=None):
+    with open(os.path.join(cubeDir, 'meta.json')) as f:
+        meta = json.load(f)
+    rows, cols = meta['shape']
+    times = len(meta['dates'])
+    name = os.path.join(cubeDir, 'cube.u8')
+    if os.path.getsize(name) > times * rows * cols:
+        os.truncate(name, times * rows * cols)
+    if meta.get('statsTimes', times) != times:
+        updateStats(cubeDir, workers)
+
+
+# =============================================================================
+# Function to open a change cube.
+
+## Usage:
+# cubeDir = folder of the cube.
+# mode = 'r' to read, 'r+' to update the statistics.
+
+## Output:
+# cube = np.memmap (time x rows x cols, uint8), None if still empty.
+# stats = dictionary name -> np.memmap (rows x cols), see STATS.
+# meta = dictionary with shape, chunk and dates of the maps.
+# =============================================================================
+def openCube(cubeDir, mode='r'):
+    with open(os.path.join(cubeDir, 'meta.json')) as f:
+        meta = json.load(f)
+    rows, cols = meta['shape']
+    times = len(meta['dates'])
+    cube = None
+    if times:
+        cube = np.memmap(os.path.join(cubeDir, 'cube.u8'), dtype=np.uint8, mode='r',
+                         shape=(times, rows, cols))
+    stats = {name: np.load(os.path.join(cubeDir, name+'.npy'), mmap_mode=mode) for name in STATS}
+    return cube, stats, meta
+
+
+## Spatial chunks (row slice, col slice) covering the tile
+def _chunks(meta):
+    rows, cols = meta['shape']
+    cr, cc = meta['chunk']
+    return [(slice(r, min(r + cr, rows)), slice(c, min(c + cc, cols)))
+            for r in range(0, rows, cr) for c in range(0, cols, cc)]
+
+
+## Add one class map (time index t) to the statistics of a chunk
+def _update(stats, window, classMap, t):
+    clear = classMap != NODATA
+    present = np.isin(classMap, SEAGRASS)
+    state = stats['state'][window]
+    seen = state != NODATA
+
+    stats['valid'][window] += clear
+    stats['seagrass'][window] += present
+    stats['gains'][window] += clear & seen & (state == 0) & present
+    stats['losses'][window] += clear & seen & (state == 1) & ~present
+
+    first = stats['first'][window]
+    first[present & (first < 0)] = t
+    stats['last'][window][present] = t
+    state[clear] = present[clear]
+
+
+# =============================================================================
+# Function to add a classified map to the cube.
+
+## Usage:
+# cubeDir = folder of the cube.
+# classMap = uint8 array (rows x cols) with classes 0-3, NODATA where masked.
+# date = str 'YYYY-MM-DD' of the image.
+# workers = number of threads for the chunk reduction.
+
+## Output:
+# time index of the new map in the cube.
+# =============================================================================
+def appendScene(cubeDir, classMap, date, workers=None):
+    _recover(cubeDir, workers)
+    cube, stats, meta = openCube(cubeDir, 'r+')
+    classMap = np.ascontiguousarray(classMap, dtype=np.uint8)
+    if list(classMap.shape) != meta['shape']:
+        raise ValueError('Class map shape '+str(classMap.shape)+' does not match the cube '+str(meta['shape']))
+
+    ## The cube is time-major, so a new map is appended at the end of the file.
+    ## The metadata lists the map once its bytes are written, and counts it in
+    ## the statistics once they are flushed.
+    with open(os.path.join(cubeDir, 'cube.u8'), 'ab') as f:
+        f.write(classMap.tobytes())
+    t = len(meta['dates'])
+    inOrder = not meta['dates'] or date >= max(meta['dates'])
+    meta['dates'].append(date)
+    meta['statsTimes'] = t
+    _saveMeta(cubeDir, meta)
+
+    if inOrder:
+        ## Incremental update: only the new map is read.
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            list(pool.map(lambda w: _update(stats, w, classMap[w], t), _chunks(meta)))
+        for stat in stats.values():
+            stat.flush()
+        meta['statsTimes'] = t + 1
+        _saveMeta(cubeDir, meta)
+    else:
+        updateStats(cubeDir, workers)
+    return t
+
+###############################################################################
+
+
+# =============================================================================
+# Function to recompute the statistics from the whole cube.
+
+## Usage:
+# cubeDir = folder of the cube.
+# workers = number of threads (one spatial chunk each at a time).
+# =============================================================================
+def updateStats(cubeDir, workers=None):
+    cube, stats, meta = openCube(cubeDir, 'r+')
+    order = np.argsort(meta['dates'], kind='stable')
+
+    def reduceChunk(window):
+        for name, (dtype, init) in STATS.items():
+            stats[name][window] = init
+        for t in order:
+            _update(stats, window, cube[(t,) + window], t)
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        list(pool.map(reduceChunk, _chunks(meta)))
+    for stat in stats.values():
+        stat.flush()
+    meta['statsTimes'] = len(meta['dates'])
+    _saveMeta(cubeDir, meta)
+
+###############################################################################
+
+
+# =============================================================================
+# Function to get the persistence of seagrass.
+
+## Usage:
+# cubeDir = folder of the cube.
+
+## Output:
+# float32 array (rows x cols): fraction of clear observations with seagrass,
+# NaN where the pixel was never clear.
+# =============================================================================
+def persistence(cubeDir):
+    _recover(cubeDir)
+    cube, stats, meta = openCube(cubeDir)
+    valid = stats['valid'].astype(np.float32)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(valid > 0, stats['seagrass'] / valid, np.nan).astype(np.float32)
+
+###############################################################################
@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+"""
+Definitions shared by the local processing modules.
+
+NODATA is the class code of masked pixels (clouds, land, turbidity, outside
+the grid) in every local class map. atomicWrite saves the caches and stores
+under a unique temporary name and renames the file when it is complete, so
+neither a crash nor a concurrent writer of the same file leaves a broken file
+where a reader expects a finished one.
+"""
+
+import os
+import tempfile
+
+## Masked pixels in the class maps
+NODATA = 255
+
+## Process umask, to give the files of atomicWrite the usual permissions
+## (mkstemp creates them readable by the owner only)
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
+
+# =============================================================================
+# Function to write a file atomically.
+
+## Usage:
+# name = final file name, with its extension (e.g. '.npy', '.npz', '.json').
+# write = function(temporary name) writing the file, e.g.
+#         lambda tmp: np.save(tmp, array).
+# =============================================================================
+def atomicWrite(name, write):
+    ## Unique temporary file in the same folder (so concurrent writers of the
+    ## same file never share it and the rename stays on one filesystem), with
+    ## the same extension so np.save/np.savez do not append their own
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(name) or '.', prefix=os.path.basename(name)+'.',
+                               suffix='.tmp'+os.path.splitext(name)[1])
+    os.close(fd)
+    os.chmod(tmp, 0o666 & ~_UMASK)
+    try:
+        write(tmp)
+        os.replace(tmp, name)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+###############################################################################
@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+"""
+Seasonal compositing of cloud-masked scenes.
+
+Scenes are grouped by tile and season and streamed, one window of rows at a
+time, into a per-pixel median (or any quantile) composite, so a season is
+classified once per tile instead of once per scene. Memory is bounded by
+the window size, not by the number of scenes.
+"""
+
+import datetime
+import numpy as np
+
+## Meteorological seasons. December goes to the winter of the next year.
+## Any other month -> name dictionary can be used (e.g. dry/wet seasons).
+SEASONS = {12:'DJF', 1:'DJF', 2:'DJF',
+           3:'MAM', 4:'MAM', 5:'MAM',
+           6:'JJA', 7:'JJA', 8:'JJA',
+           9:'SON', 10:'SON', 11:'SON'}
+
+
+# =============================================================================
+# Function to get the tile and date of a scene from its image ID.
+
+## Usage:
+# imageID = str, e.g. '20190208T160421_20190208T161051_T17RLL' (Sentinel-2)
+#           or 'LT05_018045_20010220' (Landsat 5/7/8).
+
+## Output:
+# tile = MGRS tile ('17RLL') or WRS path/row ('018045').
+# date = datetime.date of acquisition.
+# =============================================================================
+def sceneInfo(imageID):
+    parts = imageID.split('_')
+    if parts[0][:2] in ('LT', 'LE', 'LC'):
+        tile = parts[1]
+        date = parts[2]
+    else:
+        tile = parts[-1].lstrip('T')
+        date = parts[0][:8]
+    return tile, datetime.datetime.strptime(date, '%Y%m%d').date()
+
+###############################################################################
+
+
+# =============================================================================
+# Function to name the season of a date.
+
+## Usage:
+# date = datetime.date
+# seasons = dictionary month -> season name (default: SEASONS).
+
+## Output:
+# str, e.g. '2019-DJF'
+# =============================================================================
+def seasonOf(date, seasons=SEASONS):
+    year = date.year
+    ## A season spanning the new year is named after the year it ends
+    if date.month == 12 and seasons[12] == seasons[1]:
+        year += 1
+    return str(year)+'-'+seasons[date.month]
+
+###############################################################################
+
+
+# =============================================================================
+# Function to group an imageList by tile and season.
+
+## Usage:
+# imageList = list of image IDs. Duplicated IDs are kept once.
+# seasons = dictionary month -> season name (default: SEASONS).
+
+## Output:
+# dictionary (tile, season) -> list of image IDs sorted by date.
+# =============================================================================
+def groupScenes(imageList, seasons=SEASONS):
+    groups = {}
+    for imageID in dict.fromkeys(imageList):
+        tile, date = sceneInfo(imageID)
+        groups.setdefault((tile, seasonOf(date, seasons)), []).append((date, imageID))
+    return {key: [imageID for date, imageID in sorted(scenes)] for key, scenes in groups.items()}
+
+###############################################################################
+
+
+## Quantile along axis 0 ignoring NaN (masked) values, linear interpolation
+## as np.nanquantile. Sorting puts NaN last, so the k valid values are first.
+def _nanQuantile(stack, quantile, out):
+    valid = (~np.isnan(stack)).sum(axis=0)
+    stack.sort(axis=0)
+    pos = np.maximum(valid - 1, 0) * quantile
+    lo = np.floor(pos).astype(np.intp)
+    hi = np.ceil(pos).astype(np.intp)
+    low = np.take_along_axis(stack, lo[None], axis=0)[0]
+    high = np.take_along_axis(stack, hi[None], axis=0)[0]
+    np.add(low, (high - low) * (pos - lo), out=out)
+    out[valid == 0] = np.nan
+    return valid
+
+
+# =============================================================================
+# Streaming per-pixel composite.
+
+## Usage:
+# scenes = list of scenes of the same tile. Each one is either an array
+#          (bands x rows x cols, e.g. a np.memmap) or a function that returns
+#          the window asked for: scene(rowSlice, colSlice) -> (bands x n x m).
+#          Masked pixels (clouds, land) must be NaN.
+# shape = (bands, rows, cols) of the scenes.
+# quantile = 0.5 for the median.
+# maxBytes = memory allowed for the window stack (all scenes, all bands).
+#            Windows are whole rows, or parts of a row if one row is too big.
+# out = optional output array (bands x rows x cols), e.g. a np.memmap.
+
+## Output:
+# composite = float32 array (bands x rows x cols), NaN where no clear pixel.
+# count = uint16 array (rows x cols) with the number of clear observations.
+# Raises ValueError if one pixel of all the scenes does not fit in maxBytes.
+# =============================================================================
+def streamComposite(scenes, shape, quantile=0.5, maxBytes=256*2**20, out=None):
+    bands, rows, cols = shape
+    nScenes = len(scenes)
+    pixelBytes = nScenes * bands * 4
+    if pixelBytes > maxBytes:
+        raise ValueError('One pixel of '+str(nScenes)+' scenes needs '+str(pixelBytes)
+                         +' bytes, more than maxBytes ('+str(maxBytes)+')')
+    if out is None:
+        out = np.empty(shape, dtype=np.float32)
+    count = np.zeros((rows, cols), dtype=np.uint16)
+
+    ## Window so that the stack of all scenes fits in maxBytes: whole rows
+    ## if at least one row fits, otherwise part of a row
+    chunkCols = int(min(cols, maxBytes // pixelBytes))
+    chunkRows = int(max(1, min(rows, maxBytes // (pixelBytes * cols)))) if chunkCols == cols else 1
+    stack = np.empty((nScenes, bands, chunkRows, chunkCols), dtype=np.float32)
+    window = np.empty((bands, chunkRows, chunkCols), dtype=np.float32)
+
+    for start in range(0, rows, chunkRows):
+        stop = min(start + chunkRows, rows)
+        n = stop - start
+        for left in range(0, cols, chunkCols):
+            right = min(left + chunkCols, cols)
+            m = right - left
+            ## Accumulate the window of every scene into the preallocated stack
+            for s, scene in enumerate(scenes):
+                if callable(scene):
+                    stack[s, :, :n, :m] = scene(slice(start, stop), slice(left, right))
+                else:
+                    stack[s, :, :n, :m] = scene[:, start:stop, left:right]
+            valid = _nanQuantile(stack[:, :, :n, :m], quantile, window[:, :n, :m])
+            out[:, start:stop, left:right] = window[:, :n, :m]
+            ## A pixel is clear if all its bands are clear
+            count[start:stop, left:right] = valid.min(axis=0)
+
+    return out, count
+
+###############################################################################
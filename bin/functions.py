@@ -175,6 +175,28 @@ def CloudScore6S(sat, img, cloudThresh):
         
 ###############################################################################
 
+# =============================================================================
+# Function to scale L2 images to reflectance (and Kelvin for thermal bands).
+
+## Usage:
+# image = L2 image as loaded from the EE catalog or user Assets.
+# imageSource = 'ee' or 'assets'. Images from Assets are already scaled.
+# satellite = 'Sentinel2', 'Landsat8', 'Landsat7' or 'Landsat5'.
+# =============================================================================
+def applyScaleFactors(image, imageSource, satellite):
+    image = ee.Image(image)
+    if 'assets' == imageSource:
+        return image
+    if 'Sentinel' in satellite:
+        return image.divide(10000).set(image.toDictionary(image.propertyNames()))
+    thermal = 'ST_B.*' if 'Landsat8' == satellite else 'ST_B6'
+    opticalBands = image.select('SR_B.').multiply(0.0000275).add(-0.2)
+    thermalBands = image.select(thermal).multiply(0.00341802).add(149.0)
+    addBands = image.addBands(opticalBands, None, True).addBands(thermalBands, None, True)
+    return addBands.set(image.toDictionary(image.propertyNames()))
+
+###############################################################################
+
 # =============================================================================
 # Function to mask land.
 
@@ -215,7 +237,8 @@ def tidalMask(image,nir,green):
 # nir = str nir band
 # swir = str swir band
 # blue = str blue band
-# land = raster to mask land
+# land = raster to mask land: the land imageCollection or, better, its
+#        land.max() image computed once and reused for every image.
 # =============================================================================
 def turbidityMask(image,geometry,nir,swir,blue,land):
     ## Use NIR and SWIR1 bands to generate an index for turbidity
@@ -278,13 +301,55 @@ def turbidityMask(image,geometry,nir,swir,blue,land):
     ## Apply threshold value and mask possible shallow seagrass patches.
     ndsi_mask = ndsi.gte(thr2).Not()
     final_mask = ee.Image(maskTurbidity).updateMask(ndsi_mask).unmask(0)
-    final_mask = final_mask.updateMask(land.max()).clip(geometry).Not()
+    if isinstance(land, ee.ImageCollection):
+        land = land.max()
+    final_mask = final_mask.updateMask(land).clip(geometry).Not()
     output = image.updateMask(final_mask)
-    
+
     return output
 
 ###############################################################################
 
+
+# =============================================================================
+# Function to mask turbidity, keeping shallow seagrass.
+
+# Red reflectances higher than 0.02-0.03 indicate turbid waters, but sometimes
+# shallow seagrass banks. Pixels over the red threshold are masked unless they
+# look like shallow seagrass (red, green and blue under their thresholds).
+# The whole cascade is one boolean expression and one updateMask.
+
+## Usage:
+# image = image to apply the mask (reflectance, see applyScaleFactors).
+# satellite = satellite name, e.g. 'Sentinel-2A', 'Landsat8'.
+# bands = optional [red, green, blue] band names (default: by sensor).
+# =============================================================================
+def shallowTurbidityMask(image,satellite,bands=None):
+    ## Set parameter values
+    if 'Sentinel' in satellite:
+        defaults = ['B4','B3','B2']
+        red_thr_inf = 0.025
+    elif 'Landsat8' in satellite:
+        defaults = ['SR_B4','SR_B3','SR_B2']
+        red_thr_inf = 0.025
+    else:
+        defaults = ['SR_B3','SR_B2','SR_B1']
+        red_thr_inf = 0.03 #Landsat5/7 are less sensitive
+    red_thr_sup = 0.2
+    green_thr = 0.15
+    blue_thr = 0.11
+    red_band, green_band, blue_band = bands or defaults
+
+    image = ee.Image(image)
+    red = image.select(red_band)
+    ## Not turbid, or shallow seagrass
+    shallow = red.lt(red_thr_sup).And(image.select(green_band).lt(green_thr))\
+                 .And(image.select(blue_band).lt(blue_thr))
+    keep = red.lte(red_thr_inf).Or(shallow)
+    return image.updateMask(keep)
+
+###############################################################################
+
 # =============================================================================
 #  Depth-Invariant Index
 #
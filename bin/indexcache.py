@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+"""
+Per-scene cache of derived bands (spectral indices) for local processing.
+
+The local masks compute normalized differences of band pairs (NDSI in the
+cloud score, NDWI in the tidal mask). With a cache, each index is computed
+once per scene and read again by later calls on the same scene, e.g. runs
+with different flags (tiles.classifyScene computes them through the cache).
+Entries are keyed by (scene, band pair, operation, shape, version) and the
+least recently used ones are evicted when the cache goes over maxBytes, so
+batches of scenes stay within RAM.
+"""
+
+import collections
+from bandmath import compileExpression, evaluate
+
+## Band-math expression of each operation, on the band pair (a, b)
+OPERATIONS = {'nd': '(img.{a} - img.{b}) / (img.{a} + img.{b})'}
+
+
+class IndexCache:
+    """
+    Derived bands of the scenes, least recently used first out.
+
+    ## Usage:
+    # maxBytes = memory bound of the cached arrays.
+    """
+
+    def __init__(self, maxBytes=1 << 30):
+        self.maxBytes = maxBytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = collections.OrderedDict()
+
+    # =========================================================================
+    # Function to get a derived band.
+
+    ## Usage:
+    # scene = key of the scene (e.g. the image ID).
+    # img = dictionary band name -> array (rows x cols) of the scene.
+    # pair = (a, b) band names, e.g. ('B3', 'B11') for the NDSI of Sentinel-2.
+    # operation = key of OPERATIONS.
+    # scales = optional dictionary band name -> (scale, offset) if img is in DN.
+    # version = optional token of the band data (e.g. the modification time
+    #           of the scene in a scenestore.SceneStore); pass a new one when
+    #           the bands of the scene change.
+
+    ## Output:
+    # float32 array (rows x cols). It is shared: do not modify it.
+    # =========================================================================
+    def index(self, scene, img, pair, operation='nd', scales=None, version=None):
+        a, b = pair
+        ## The shape is in the key, so an overview or a tile of the scene
+        ## gets its own entry
+        key = (scene, tuple(pair), operation, tuple(img[a].shape), version)
+        if key in self._entries:
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return self._entries[key]
+
+        self.misses += 1
+        program = compileExpression(OPERATIONS[operation].format(a=a, b=b))
+        array = evaluate(program, img, scales=scales)
+        array.flags.writeable = False
+        self._entries[key] = array
+        self.nbytes += array.nbytes
+        while self.nbytes > self.maxBytes and len(self._entries) > 1:
+            _, old = self._entries.popitem(last=False)
+            self.nbytes -= old.nbytes
+            self.evictions += 1
+        return array
+
+    ## Drop the derived bands of a scene (e.g. when it is done).
+    def drop(self, scene):
+        for key in [key for key in self._entries if key[0] == scene]:
+            self.nbytes -= self._entries.pop(key).nbytes
+
+    ## Hits, misses, evictions, entries and bytes in use
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                'entries': len(self._entries), 'nbytes': self.nbytes}
@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+"""
+Cached land masks.
+
+The land (water mask) collection is collapsed once per tile grid and
+resolution into a bit-packed raster (1 bit per pixel, 1 = water) saved as
+.npy and memory-mapped when reused. Masking land in a scene is then a
+bitwise lookup of the rows being processed instead of a reduction of the
+whole collection.
+"""
+
+import os
+import hashlib
+import numpy as np
+from common import atomicWrite
+
+
+# =============================================================================
+# Function to name the land mask of a grid.
+
+## Usage:
+# tile = str tile id (MGRS tile or WRS path/row).
+# shape = (rows, cols) of the grid.
+# transform = affine geotransform [x0, dx, 0, y0, 0, dy] of the grid.
+# crs = str coordinate reference system of the grid.
+
+## Output:
+# str key, e.g. '17RLM_10980x10980_3f2a9c1b'
+# =============================================================================
+def gridKey(tile, shape, transform, crs='EPSG:4326'):
+    grid = repr((tuple(shape), tuple(float(v) for v in transform), crs)).encode()
+    return str(tile)+'_'+str(shape[0])+'x'+str(shape[1])+'_'+hashlib.sha1(grid).hexdigest()[:8]
+
+###############################################################################
+
+
+# =============================================================================
+# Function to collapse the land collection (local equivalent of land.max()).
+
+## Usage:
+# landImages = list of arrays (rows x cols) of the land collection on the grid,
+#              values > 0 are water, NaN or 0 elsewhere.
+# chunkRows = rows reduced at a time.
+
+## Output:
+# bit-packed uint8 array (rows x ceil(cols/8)), 1 = water.
+# =============================================================================
+def collapseLand(landImages, chunkRows=1024):
+    rows, cols = landImages[0].shape
+    packed = np.empty((rows, (cols + 7) // 8), dtype=np.uint8)
+    water = np.empty((chunkRows, cols), dtype=bool)
+    for start in range(0, rows, chunkRows):
+        stop = min(start + chunkRows, rows)
+        window = water[:stop - start]
+        window[:] = False
+        for image in landImages:
+            ## NaN > 0 is False, so no-data never counts as water
+            window |= np.asarray(image[start:stop]) > 0
+        packed[start:stop] = np.packbits(window, axis=1)
+    return packed
+
+###############################################################################
+
+
+# =============================================================================
+# Function to get a land mask from the cache, building it the first time.
+
+## Usage:
+# cacheDir = folder of the cached masks.
+# key = name of the grid (from gridKey).
+# build = function returning the list of land images on the grid (only
+#         called if the mask is not cached yet).
+
+## Output:
+# bit-packed np.memmap (rows x ceil(cols/8)), 1 = water.
+# =============================================================================
+def cachedLandMask(cacheDir, key, build):
+    name = os.path.join(cacheDir, 'land_'+key+'.npy')
+    if not os.path.exists(name):
+        os.makedirs(cacheDir, exist_ok=True)
+        atomicWrite(name, lambda tmp: np.save(tmp, collapseLand(build())))
+    return np.load(name, mmap_mode='r')
+
+###############################################################################
+
+
+# =============================================================================
+# Function to unpack the water pixels of some rows.
+
+## Usage:
+# packed = bit-packed land mask (from cachedLandMask).
+# cols = number of columns of the grid.
+# rows = slice of rows (default: all).
+
+## Output:
+# bool array (rows x cols), True = water.
+# =============================================================================
+def waterWindow(packed, cols, rows=slice(None)):
+    return np.unpackbits(packed[rows], axis=1, count=cols).view(bool)
+
+###############################################################################
+
+
+# =============================================================================
+# Function to mask land in an image (local equivalent of updateMask(land.max())).
+
+## Usage:
+# image = float array (bands x rows x cols) of the rows being processed; it is masked in place.
+# packed = bit-packed land mask of the grid.
+# rows = slice of the grid rows covered by image (default: all).
+
+## Output:
+# image with land pixels set to NaN.
+# =============================================================================
+def applyLandMask(image, packed, rows=slice(None)):
+    water = waterWindow(packed, image.shape[-1], rows)
+    image[:, ~water] = np.nan
+    return image
+
+###############################################################################
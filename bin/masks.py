@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+"""
+Local (NumPy) versions of the masks in functions.py.
+
+Images are dictionaries band name -> array (rows x cols), float32
+reflectance with NaN for masked pixels, or uint16 DN with their scale
+factors (scaling.py). Band math goes through the compiled
+expressions of bandmath.py and is evaluated by windows of rows.
+"""
+
+import numpy as np
+from bandmath import compileExpression, evaluate
+
+
+## Sensor name as used in the tables below
+def sensor(sat):
+    if 'Sentinel' in sat:
+        return 'Sentinel'
+    for name in ('Landsat8', 'Landsat7', 'Landsat5'):
+        if name in sat:
+            return name
+    raise ValueError('Unknown satellite: '+str(sat))
+
+
+## Cloud tests of CloudScore6S: (expression, [t0, t1]) rescaled as functions.rescale
+CLOUD_TESTS = {
+    'Sentinel': [('img.B2', [0.01, 0.3]),
+                 ('img.B1', [0.01, 0.3]),
+                 ('img.B4 + img.B3 + img.B2', [0.01, 0.8]),
+                 ('img.B8 + img.B11 + img.B12', [0.01, 0.8])],
+    'Landsat8': [('img.SR_B2', [0.01, 0.3]),
+                 ('img.SR_B1', [0.01, 0.3]),
+                 ('img.SR_B4 + img.SR_B3 + img.SR_B2', [0.2, 0.8]),
+                 ('img.SR_B5 + img.SR_B6 + img.SR_B7', [0.1, 0.8]),
+                 ('img.ST_B10', [296, 280])],
+    'Landsat7': [('img.SR_B1', [0.01, 0.3]),
+                 ('img.SR_B3 + img.SR_B2 + img.SR_B1', [0.2, 0.8]),
+                 ('img.SR_B4 + img.SR_B5 + img.SR_B7', [0.1, 0.8]),
+                 ('img.ST_B6', [296, 280])],
+    }
+CLOUD_TESTS['Landsat5'] = CLOUD_TESTS['Landsat7']
+
+## Green and SWIR1 bands of the snow index (NDSI) used by CloudScore6S
+CLOUD_NDSI = {'Sentinel': ('B3', 'B11'), 'Landsat8': ('SR_B3', 'SR_B6'),
+              'Landsat7': ('SR_B3', 'SR_B5'), 'Landsat5': ('SR_B3', 'SR_B5')}
+
+
+# =============================================================================
+# Local version of CloudScore6S.
+
+## Usage:
+# sat = satellite name, e.g. 'Sentinel-2A', 'Landsat8'.
+# img = dictionary band name -> array (rows x cols).
+# cloudThresh = integer threshold (pixels with a score below it are clear).
+# chunkRows = rows computed at a time.
+# scales = optional dictionary band name -> (scale, offset) if img is in DN.
+# cache, scene = optional indexcache.IndexCache and key of the scene, to read
+#                the NDSI from (and leave it in) the cache.
+# version = optional token of the band data, see IndexCache.index.
+
+## Output:
+# score = uint8 array (rows x cols), cloud score 0-100.
+# cloudMask = bool array (rows x cols), True where clear.
+# =============================================================================
+def cloudScore(sat, img, cloudThresh, chunkRows=256, scales=None, cache=None, scene=None, version=None):
+    from scaling import scaled
+
+    name = sensor(sat)
+    green, swir = CLOUD_NDSI[name]
+    ## However, clouds are not snow: NDSI and its rescale compiled in one expression
+    ndsi = '(img.'+green+' - img.'+swir+') / (img.'+green+' + img.'+swir+')'
+    programs = [compileExpression(exp, (tuple(thr), 'rescale')) for exp, thr in CLOUD_TESTS[name]]
+    if cache is None:
+        programs.append(compileExpression(ndsi, ((0.8, 0.6), 'rescale')))
+    else:
+        img = dict(img, ndsi=cache.index(scene, img, (green, swir), 'nd', scales, version))
+        programs.append(compileExpression('img.ndsi', ((0.8, 0.6), 'rescale')))
+
+    rows, cols = img[programs[0].bands[0]].shape
+    score = np.empty((rows, cols), dtype=np.uint8)
+    window = np.empty((chunkRows, cols), dtype=np.float32)
+    test = np.empty((chunkRows, cols), dtype=np.float32)
+    ## Buffers shared by all programs and windows; DN bands are scaled once
+    ## per window, not once per program reading them
+    workspace = {}
+    used = list(dict.fromkeys(band for p in programs for band in p.bands))
+    scaledBands = {band: np.empty((chunkRows, cols), dtype=np.float32)
+                   for band in used if scales and band in scales}
+
+    for start in range(0, rows, chunkRows):
+        stop = min(start + chunkRows, rows)
+        n = stop - start
+        for band, buffer in scaledBands.items():
+            scaled(img[band][start:stop], *scales[band], out=buffer[:n])
+        bands = {band: scaledBands[band][:n] if band in scaledBands else img[band][start:stop]
+                 for band in used}
+        ## Take the minimum of the indicators of cloudyness (starting at 1)
+        window[:n] = 1.0
+        for program in programs:
+            evaluate(program, bands, test[:n], chunkRows, workspace=workspace)
+            ## np.minimum propagates NaN, so masked input stays masked
+            np.minimum(window[:n], test[:n], out=window[:n])
+        clear = ~np.isnan(window[:n])
+        ## .multiply(100).byte()
+        np.multiply(window[:n], 100, out=window[:n])
+        np.clip(window[:n], 0, 255, out=window[:n])
+        score[start:stop] = np.where(clear, window[:n], 255).astype(np.uint8)
+
+    cloudMask = score < int(cloudThresh)
+    return score, cloudMask
+
+###############################################################################
+
+
+## NIR and green bands of the NDWI used by tidalMask
+TIDAL_BANDS = {'Sentinel': ('B8', 'B3'), 'Landsat8': ('SR_B5', 'SR_B3'),
+               'Landsat7': ('SR_B4', 'SR_B2'), 'Landsat5': ('SR_B4', 'SR_B2')}
+
+
+# =============================================================================
+# Local version of tidalMask.
+
+## Usage:
+# img = dictionary band name -> array (rows x cols).
+# nir, green = str band names.
+# scales = optional dictionary band name -> (scale, offset) if img is in DN.
+# cache, scene, version = optional indexcache.IndexCache, key of the scene and
+#                         token of the band data, as in cloudScore.
+
+## Output:
+# bool array (rows x cols), True where kept (NDWI below -0.4).
+# =============================================================================
+def tidalMask(img, nir, green, scales=None, cache=None, scene=None, version=None):
+    if cache is None:
+        from bandmath import normalizedDifference
+        ndwi = normalizedDifference(img, (nir, green), scales=scales)
+    else:
+        ndwi = cache.index(scene, img, (nir, green), 'nd', scales, version)
+    return ndwi < -0.4
+
+###############################################################################
+
+
+## Red, green and blue bands and red thresholds (inf, sup) of shallowTurbidityMask
+TURBIDITY_BANDS = {'Sentinel': (('B4', 'B3', 'B2'), (0.025, 0.2)),
+                   'Landsat8': (('SR_B4', 'SR_B3', 'SR_B2'), (0.025, 0.2)),
+                   'Landsat7': (('SR_B3', 'SR_B2', 'SR_B1'), (0.03, 0.2)),
+                   'Landsat5': (('SR_B3', 'SR_B2', 'SR_B1'), (0.03, 0.2))}
+TURBIDITY_GREEN = 0.15
+TURBIDITY_BLUE = 0.11
+
+
+# =============================================================================
+# Local version of shallowTurbidityMask.
+
+## Usage:
+# sat = satellite name.
+# img = dictionary band name -> array (rows x cols).
+# bands = optional (red, green, blue) band names (default: by sensor).
+# chunkRows = rows computed at a time.
+# scales = optional dictionary band name -> (scale, offset) if img is in DN.
+
+## Output:
+# uint8 array (rows x ceil(cols / 8)), bits packed along the columns
+# (np.unpackbits(mask, axis=1, count=cols)): 1 where the pixel is kept
+# (clear water or shallow seagrass), 0 where turbid or masked.
+# =============================================================================
+def shallowTurbidityMask(sat, img, bands=None, chunkRows=256, scales=None):
+    from scaling import scaled
+
+    defaults, (redInf, redSup) = TURBIDITY_BANDS[sensor(sat)]
+    bands = tuple(bands or defaults)
+    rows, cols = img[bands[0]].shape
+    mask = np.empty((rows, (cols + 7) // 8), dtype=np.uint8)
+    windows = [np.empty((chunkRows, cols), dtype=np.float32) for _ in bands]
+    keep = np.empty((chunkRows, cols), dtype=bool)
+    test = np.empty((chunkRows, cols), dtype=bool)
+
+    for start in range(0, rows, chunkRows):
+        stop = min(start + chunkRows, rows)
+        n = stop - start
+        red, green, blue = [w[:n] for w in windows]
+        for band, window in zip(bands, (red, green, blue)):
+            if scales and band in scales:
+                scaled(img[band][start:stop], *scales[band], out=window)
+            else:
+                window[...] = img[band][start:stop]
+        ## Shallow seagrass: red < sup, green < thr, blue < thr (NaN compares False)
+        np.less(red, redSup, out=keep[:n])
+        np.less(green, TURBIDITY_GREEN, out=test[:n])
+        keep[:n] &= test[:n]
+        np.less(blue, TURBIDITY_BLUE, out=test[:n])
+        keep[:n] &= test[:n]
+        ## ...or not turbid
+        np.less_equal(red, redInf, out=test[:n])
+        keep[:n] |= test[:n]
+        mask[start:stop] = np.packbits(keep[:n], axis=1)
+
+    return mask
+
+###############################################################################
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+"""
+Local accuracy metrics for the classified images.
+
+Confusion matrices are built with bincount from label/prediction arrays and
+every derived measure (accuracy, producer/user accuracies, kappa) is computed
+for a whole batch of images at once on an N x 4 x 4 stack of matrices.
+Definitions follow ee.ConfusionMatrix: rows are the actual classes and
+columns the predicted classes.
+"""
+
+import numpy as np
+
+## Class codes, same as the sheets saved by process.py
+rowIndex = {0:'Sb', 1:'Hb', 2:'Dn', 3:'Sp'}
+nClasses = len(rowIndex)
+
+
+# =============================================================================
+# Function to build a confusion matrix.
+
+## Usage:
+# actual = int array of ground-truth classes.
+# predicted = int array of predicted classes.
+# n = number of classes.
+
+## Output:
+# int64 array (n x n), rows = actual, columns = predicted.
+# =============================================================================
+def confusionMatrix(actual, predicted, n=nClasses):
+    actual = np.asarray(actual, dtype=np.int64)
+    predicted = np.asarray(predicted, dtype=np.int64)
+    counts = np.bincount(actual * n + predicted, minlength=n * n)
+    return counts.reshape(n, n)
+
+###############################################################################
+
+
+# =============================================================================
+# Function to build the confusion matrices of many images in one pass.
+
+## Usage:
+# actual = int array of ground-truth classes (all images concatenated).
+# predicted = int array of predicted classes (all images concatenated).
+# image = int array with the image number (0..N-1) of every point.
+# nImages = number of images (default: image.max() + 1).
+# n = number of classes.
+
+## Output:
+# int64 array (N x n x n).
+# =============================================================================
+def confusionMatrices(actual, predicted, image, nImages=None, n=nClasses):
+    actual = np.asarray(actual, dtype=np.int64)
+    predicted = np.asarray(predicted, dtype=np.int64)
+    image = np.asarray(image, dtype=np.int64)
+    if nImages is None:
+        nImages = int(image.max()) + 1 if image.size else 0
+
+    counts = np.bincount((image * n + actual) * n + predicted, minlength=nImages * n * n)
+    return counts.reshape(nImages, n, n)
+
+###############################################################################
+
+
+# =============================================================================
+# Function to compute the accuracy measures of one or many confusion matrices.
+
+## Usage:
+# matrices = array (n x n) or (N x n x n).
+
+## Output:
+# dictionary with 'accuracy' (N), 'producer' (N x n), 'user' (N x n) and
+# 'kappa' (N). Classes without points get an accuracy of 0, as in EE.
+# =============================================================================
+def accuracies(matrices):
+    matrices = np.asarray(matrices, dtype=np.float64)
+    total = matrices.sum(axis=(-2, -1))
+    diag = np.diagonal(matrices, axis1=-2, axis2=-1)
+    actual = matrices.sum(axis=-1)
+    predicted = matrices.sum(axis=-2)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        accuracy = diag.sum(axis=-1) / total
+        producer = np.where(actual > 0, diag / actual, 0.0)
+        user = np.where(predicted > 0, diag / predicted, 0.0)
+        expected = (actual * predicted).sum(axis=-1) / (total * total)
+        kappa = (accuracy - expected) / (1 - expected)
+
+    return {'accuracy': accuracy, 'producer': producer, 'user': user, 'kappa': kappa}
+
+###############################################################################
+
+
+# =============================================================================
+# Function to summarize a batch of images in one table.
+
+## Usage:
+# names = list of image IDs (N).
+# matrices = array (N x n x n), e.g. from confusionMatrices.
+
+## Output:
+# pandas DataFrame with one row per image: points, accuracy, kappa and the
+# producer/user accuracies of each class.
+# =============================================================================
+def batchReport(names, matrices):
+    import pandas as pd
+
+    matrices = np.asarray(matrices)
+    scores = accuracies(matrices)
+    classes = [rowIndex[c] for c in range(matrices.shape[-1])]
+
+    report = pd.DataFrame({'Points': matrices.sum(axis=(-2, -1)),
+                           'Accuracy': scores['accuracy'],
+                           'Kappa': scores['kappa']}, index=list(names))
+    for c, name in enumerate(classes):
+        report['Producer_'+name] = scores['producer'][:, c]
+    for c, name in enumerate(classes):
+        report['User_'+name] = scores['user'][:, c]
+    return report
+
+###############################################################################
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+"""
+Batch planning of an imageList.
+
+Duplicated image IDs are removed and scenes are grouped by MGRS tile or WRS
+path/row, so the work that only depends on the tile (filtering sand polygons
+and ground points by the AOI and the tile) is built once per tile and shared by
+all its scenes. Each scene then filters the tile subsets by its own footprint,
+which only scans the few features of the tile instead of the full collections.
+"""
+
+from composite import sceneInfo
+
+
+# =============================================================================
+# Function to get the folder (EE collection or user Assets) of the images.
+
+## Usage:
+# imageSource = 'ee' or 'assets', as in start_processing.
+# satellite = 'Sentinel2', 'Landsat8', 'Landsat7' or 'Landsat5'.
+# boaFolder = folder of the L2 images in Assets (only used if imageSource is 'assets').
+
+## Output:
+# str to prepend to the image ID.
+# =============================================================================
+def collectionPath(imageSource, satellite, boaFolder=''):
+    if 'assets' == imageSource:
+        return "projects/imars-3d-wetlands/Sentinel-2_L2_Luis/"+boaFolder+'/'
+    if 'Sentinel' in satellite:
+        return "COPERNICUS/S2_SR_HARMONIZED/"
+    elif 'Landsat8' == satellite:
+        return "LANDSAT/LC08/C02/T1_L2/"
+    elif 'Landsat7' == satellite:
+        return "LANDSAT/LE07/C02/T1_L2/"
+    elif 'Landsat5' == satellite:
+        return "LANDSAT/LT05/C02/T1_L2/"
+    raise ValueError('Unknown satellite: '+str(satellite))
+
+###############################################################################
+
+
+# =============================================================================
+# Function to deduplicate and group an imageList by tile.
+
+## Usage:
+# imageList = list of image IDs.
+
+## Output:
+# dictionary tile -> list of image IDs, tiles and scenes in order of first appearance.
+# =============================================================================
+def planScenes(imageList):
+    plan = {}
+    for imageID in dict.fromkeys(imageList):
+        try:
+            tile, date = sceneInfo(imageID)
+        except (ValueError, IndexError):
+            ## IDs not following the EE naming (e.g. renamed assets) form their own group
+            tile = imageID
+        plan.setdefault(tile, []).append(imageID)
+    return plan
+
+###############################################################################
+
+
+# =============================================================================
+# Function to build the tile-level inputs shared by all scenes of a tile.
+
+## Usage:
+# imageIDs = list of image IDs of the tile (from planScenes).
+# collection = folder of the images (from collectionPath).
+# aoi = featureCollection of the region of interest.
+# sand_areas = featureCollection of sand polygons for DII.
+# groundPoints = featureCollection of ground-truth points.
+
+## Output:
+# dictionary with the tile footprint ('geometry'), the sand polygons ('sand')
+# and the ground points ('points') inside it. Filter them by the footprint of
+# each scene (filterBounds(imageGeometry)) before use: scenes of a tile do not
+# all cover the same area.
+# =============================================================================
+def tileArtifacts(imageIDs, collection, aoi, sand_areas, groundPoints):
+    import ee
+
+    ## Union of the footprints of all scenes of the tile
+    geometry = ee.ImageCollection([ee.Image(collection+imageID) for imageID in imageIDs]).geometry()
+    sand = ee.FeatureCollection(sand_areas).filterBounds(geometry)
+    points = ee.FeatureCollection(groundPoints).filterBounds(aoi).filterBounds(geometry)
+    return {'geometry': geometry, 'sand': sand, 'points': points}
+
+###############################################################################
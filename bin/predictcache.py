@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+"""
+Memoized prediction of quantized feature vectors.
+
+Much of a scene is homogeneous water or sand, so the bandsClass vectors of
+many pixels are the same after rounding to a modest reflectance precision.
+PredictionCache rounds the vectors of a chunk, finds the unique ones with
+np.unique, predicts each one once (or takes it from the memo of the previous
+chunks) and scatters the classes back to the pixels. disagreement() tells how
+often the rounding changes the class, to pick a safe precision.
+"""
+
+import numpy as np
+from common import NODATA
+
+
+## Rounded vectors (int32) of the valid rows of features
+def _quantize(features, precision):
+    return np.rint(features / precision).astype(np.int32)
+
+
+class PredictionCache:
+    """
+    Classifier wrapper predicting each quantized vector once.
+
+    ## Usage:
+    # model = fitted classifier with predict() (exact SVC or approxsvm.fitApproximate).
+    # precision = rounding step of the features: one value, or one per feature
+    #             (e.g. 0.001 for reflectances and 0.01 for the DII band).
+    # maxEntries = memo size bound (vectors); the memo is emptied when full.
+    """
+
+    def __init__(self, model, precision=0.001, maxEntries=2000000):
+        self.model = model
+        self.precision = np.asarray(precision, dtype=np.float32)
+        self.maxEntries = maxEntries
+        self._memo = {}
+        self.pixels = 0
+        self.unique = 0
+        self.predicted = 0
+        self.resets = 0
+
+    # =========================================================================
+    # Function to predict the classes of a chunk of pixels.
+
+    ## Usage:
+    # features = array (pixels x features), NaN where masked.
+
+    ## Output:
+    # uint8 array (pixels) of classes, NODATA where masked.
+    # =========================================================================
+    def predict(self, features):
+        features = np.asarray(features, dtype=np.float32)
+        classes = np.full(len(features), NODATA, dtype=np.uint8)
+        valid = ~np.isnan(features).any(axis=1)
+        if not valid.any():
+            return classes
+        q = np.ascontiguousarray(_quantize(features[valid], self.precision))
+
+        ## Unique vectors of the chunk: rows compared as raw bytes
+        rows = q.view(np.dtype((np.void, q.dtype.itemsize * q.shape[1]))).ravel()
+        uniqueRows, first, inverse = np.unique(rows, return_index=True, return_inverse=True)
+        keys = [row.tobytes() for row in uniqueRows]
+        uniqueClasses = np.array([self._memo.get(key, NODATA) for key in keys], dtype=np.uint8)
+
+        ## Predict the vectors not in the memo, at the center of their cell
+        new = uniqueClasses == NODATA
+        if new.any():
+            centers = q[first[new]].astype(np.float32) * self.precision
+            uniqueClasses[new] = self.model.predict(centers)
+            if len(self._memo) + int(new.sum()) > self.maxEntries:
+                self._memo.clear()
+                self.resets += 1
+            if int(new.sum()) <= self.maxEntries:
+                self._memo.update(zip([key for key, n in zip(keys, new) if n], uniqueClasses[new].tolist()))
+
+        classes[valid] = uniqueClasses[inverse.ravel()]
+        self.pixels += int(valid.sum())
+        self.unique += len(keys)
+        self.predicted += int(new.sum())
+        return classes
+
+    ## Valid pixels, unique vectors, vectors predicted, hit rate (pixels not
+    ## sent to the model), memo entries and resets
+    def stats(self):
+        return {'pixels': self.pixels, 'unique': self.unique, 'predicted': self.predicted,
+                'hitRate': 1 - self.predicted / self.pixels if self.pixels else None,
+                'entries': len(self._memo), 'resets': self.resets}
+
+
+# =============================================================================
+# Function to measure how often quantization changes the predicted class.
+
+## Usage:
+# model = fitted classifier.
+# features = array (pixels x features) of a scene, NaN where masked.
+# precisions = list of precisions to test (as in PredictionCache).
+# sample = pixels drawn at random from the valid ones.
+# seed = random seed of the sample.
+
+## Output:
+# dictionary precision -> dictionary with 'disagreement' (fraction of the
+# sampled pixels with a different class), 'hitRate' (pixels not sent to the
+# model) and 'matrix' (unquantized x quantized classes, see metrics.py).
+# =============================================================================
+def disagreement(model, features, precisions=(0.0005, 0.001, 0.002, 0.005), sample=100000, seed=0,
+                 nClasses=4):
+    from metrics import confusionMatrix
+
+    features = np.asarray(features, dtype=np.float32)
+    valid = np.flatnonzero(~np.isnan(features).any(axis=1))
+    rng = np.random.default_rng(seed)
+    pick = features[rng.choice(valid, min(sample, valid.size), replace=False)]
+    exact = model.predict(pick)
+
+    report = {}
+    for precision in precisions:
+        cache = PredictionCache(model, precision)
+        quantized = cache.predict(pick)
+        report[precision] = {'disagreement': float((quantized != exact).mean()) if len(pick) else None,
+                             'hitRate': cache.stats()['hitRate'],
+                             'matrix': confusionMatrix(exact, quantized, nClasses)}
+    return report
+
+###############################################################################
@@ -1,5 +1,6 @@
 def start_processing(imageSource,satellite,regionName,boaFolder,exportFolder,dataFolder,smoothStr,
-                     nameCode,regionCountry,state,imageList,sand_areas,groundPoints,land,regions,cloud,dii,flat,turbid):
+                     nameCode,regionCountry,state,imageList,sand_areas,groundPoints,land,regions,cloud,dii,flat,turbid,folds=0,screen=None,
+                     sampleCache=None,stratified=True,defer=False):
     """
     Description of arguments required:
     ----------------------------------
@@ -13,7 +14,7 @@ def start_processing(imageSource,satellite,regionName,boaFolder,exportFolder,dat
     nameCode (str)    = used as metadata. Unique codes of four digits related to the loaded region in regionName.
     regionCountry(str)= used as metadata. Country of the region of interest.
     state (str)       = used as metadata. State of the region of interest, if applicable.
-    imageList (list)  = list of specific image IDs.
+    imageList (list)  = list of specific image IDs. Duplicated IDs are processed once, and scenes are processed grouped by tile.
     sand_areas (ee object) = to import featureCollection (dataset) of sand polygons for DII.
     groundPoints (ee object) = to import featureCollection (dataset) of ground-truth points.
     land (ee object)  = to import imageCollection (dataset) of predefined images to mask land.
@@ -22,12 +23,31 @@ def start_processing(imageSource,satellite,regionName,boaFolder,exportFolder,dat
     dii (int)         = use 1 to apply depth invariant index and add it as band, if not set as 0.
     flat (int)        = use 1 to apply tidal flat mask, if not set as 0.
     turbid (int)      = use 1 to apply turbidity mask, if not set as 0.
+    folds (int)       = use k > 1 to replace the 70/30 split by a k-fold cross-validation of the sampled points. The exported
+                        classifier is then trained on all points. Set as 0 to keep the single 70/30 split.
+    screen (dict)     = minimums to pre-screen the images before processing, e.g. {'clear': 0.2, 'points': 20, 'sand': 1}
+                        (see screening.py). Images that fail are skipped and the reason is printed. None to process all images.
+    sampleCache (str) = folder of the sample cache (see samplecache.py). Only the ground points that are new or moved since the
+                        last run are sampled, and the classifier is trained and validated on the cached table (the 70/30 split
+                        is drawn on that table, so it differs from the split of the sampled points). None to sample all points
+                        every time.
+    stratified (bool) = if True, the k folds keep the class proportions of the points. Only used if folds > 1.
+    defer (bool)      = if True, images that fail the screen are deferred instead of rejected, and their IDs are returned
+                        (e.g. to run them again later with lower minimums). Only used with screen.
+
+    Returns the list of deferred image IDs (empty if defer is False or no image was deferred).
     """
     
+    import numpy as np
     import pandas as pd
     import xlsxwriter
     import datetime
-    from functions import CloudScore6S,landMaskFunction,tidalMask,turbidityMask,DII
+    from functions import applyScaleFactors,CloudScore6S,landMaskFunction,tidalMask,turbidityMask,DII
+    from validation import featureTable,tableCollection,crossValidate
+    from metrics import confusionMatrix,accuracies,batchReport
+    from planner import collectionPath,planScenes,tileArtifacts
+    from screening import screenScenes
+    from samplecache import cachedSamples
     
     from google.colab import auth
     auth.authenticate_user()
@@ -42,9 +62,37 @@ def start_processing(imageSource,satellite,regionName,boaFolder,exportFolder,dat
     
     print('Initiating...')
 
+    ## Validation matrices of every image, for the summary at the end
+    campaignImages = []
+    campaignMatrices = []
+
+    ## Region of interest:
+    aoi = regions.filter(ee.Filter.eq('name',regionName))
+
+    ## Land mask, the same for all images. Collapsed once and used by the
+    ## land mask step and turbidityMask (see landcache.py for local runs).
+    landMax = land.max()
+
+    ## Skip images too cloudy or with too few ground points/sand polygons
+    ## (sand polygons are only checked when the DII is applied)
+    deferred = []
+    if screen is not None:
+        imageList, skipped, checks = screenScenes(imageList, imageSource, satellite, boaFolder, aoi,
+                                                  sand_areas, groundPoints, screen if dii == 1 else dict(screen, sand=None), defer)
+        deferred = [imageID for imageID, (status, reason) in skipped.items() if status == 'deferred']
+
+    ## Remove duplicated IDs and group scenes by tile (MGRS tile or WRS path/row),
+    ## so the filtering of sand polygons and ground points is done once per tile.
+    plan = planScenes(imageList)
+    sceneList = [(tile, imageID) for tile in plan for imageID in plan[tile]]
+    collection = collectionPath(imageSource, satellite, boaFolder)
+    tileCache = {}
+
     ## Initiate loop:
-    for i in range(len(imageList)):
-        imageID = imageList[i]
+    for i in range(len(sceneList)):
+        tile, imageID = sceneList[i]
+        if tile not in tileCache:
+            tileCache[tile] = tileArtifacts(plan[tile], collection, aoi, sand_areas, groundPoints)
 
         print('Preparing image '+imageID)
 
@@ -53,10 +101,7 @@ def start_processing(imageSource,satellite,regionName,boaFolder,exportFolder,dat
         ## If the image source is your asset, then define the folder where the satellite image is:
         if 'assets'== imageSource:
             ## Load BOA image from assets:
-            if 'Sentinel' in satellite:
-                imageTarget = ee.Image("projects/imars-3d-wetlands/Sentinel-2_L2_Luis/"+boaFolder+'/'+imageID)
-            elif 'Landsat' in satellite:
-                imageTarget = ee.Image("projects/imars-3d-wetlands/Sentinel-2_L2_Luis/"+boaFolder+'/'+imageID)
+            imageTarget = ee.Image(collection+imageID)
             ## Get image metadata:
             imageSat = imageTarget.get('satellite').getInfo() #Image satellite
             imageTile = imageTarget.get('tile_id').getInfo() #Image tile id
@@ -67,45 +112,30 @@ def start_processing(imageSource,satellite,regionName,boaFolder,exportFolder,dat
         if 'ee'== imageSource:
             ## Load BOA image collection from EE cloud:
             if 'Sentinel' in satellite:
-                image = ee.Image("COPERNICUS/S2_SR_HARMONIZED/"+imageID)
-                imageTarget = image.divide(10000).set(image.toDictionary(image.propertyNames()))
+                image = ee.Image(collection+imageID)
+                imageTarget = applyScaleFactors(image, imageSource, satellite)
                 imageSat = imageTarget.get('SPACECRAFT_NAME').getInfo() #Image satellite
                 imageTile = imageTarget.get('MGRS_TILE').getInfo() #Image tile id
                 ee_date = imageTarget.get('GENERATION_TIME').getInfo()
                 imageDate = str(datetime.datetime.utcfromtimestamp(ee_date/1000.0)) #Image date
                 imageGeometry = imageTarget.geometry() #Tile geometry.
             elif 'Landsat8' == satellite:
-                image = ee.Image("LANDSAT/LC08/C02/T1_L2/"+imageID)
-                def applyScaleFactors(img):
-                  opticalBands = img.select('SR_B.').multiply(0.0000275).add(-0.2)
-                  thermalBands = img.select('ST_B.*').multiply(0.00341802).add(149.0)
-                  addBands = img.addBands(opticalBands, None, True).addBands(thermalBands, None, True)
-                  return addBands.set(img.toDictionary(img.propertyNames()))
-                imageTarget = applyScaleFactors(image)
+                image = ee.Image(collection+imageID)
+                imageTarget = applyScaleFactors(image, imageSource, satellite)
                 imageSat = satellite
                 imageTile = str(imageTarget.get('WRS_PATH').getInfo())+str(imageTarget.get('WRS_ROW').getInfo()) #Image tile id
                 imageDate = ee.Date(imageTarget.get('system:time_start')).format("YYYY-MM-dd").getInfo()
                 imageGeometry = imageTarget.geometry() #Tile geometry.
             elif 'Landsat7' == satellite:
-                image = ee.Image("LANDSAT/LE07/C02/T1_L2/"+imageID)
-                def applyScaleFactors(img):
-                  opticalBands = img.select('SR_B.').multiply(0.0000275).add(-0.2)
-                  thermalBands = img.select('ST_B6').multiply(0.00341802).add(149.0)
-                  addBands = img.addBands(opticalBands, None, True).addBands(thermalBands, None, True)
-                  return addBands.set(img.toDictionary(img.propertyNames()))
-                imageTarget = applyScaleFactors(image)
+                image = ee.Image(collection+imageID)
+                imageTarget = applyScaleFactors(image, imageSource, satellite)
                 imageSat = satellite
                 imageTile = str(imageTarget.get('WRS_PATH').getInfo())+str(imageTarget.get('WRS_ROW').getInfo()) #Image tile id
                 imageDate = ee.Date(imageTarget.get('system:time_start')).format("YYYY-MM-dd").getInfo()
                 imageGeometry = imageTarget.geometry() #Tile geometry.
             elif 'Landsat5' == satellite:
-                image = ee.Image("LANDSAT/LT05/C02/T1_L2/"+imageID)
-                def applyScaleFactors(img):
-                  opticalBands = img.select('SR_B.').multiply(0.0000275).add(-0.2)
-                  thermalBands = img.select('ST_B6').multiply(0.00341802).add(149.0)
-                  addBands = img.addBands(opticalBands, None, True).addBands(thermalBands, None, True)
-                  return addBands.set(img.toDictionary(img.propertyNames()))
-                imageTarget = applyScaleFactors(image)
+                image = ee.Image(collection+imageID)
+                imageTarget = applyScaleFactors(image, imageSource, satellite)
                 imageSat = satellite
                 imageTile = str(imageTarget.get('WRS_PATH').getInfo())+str(imageTarget.get('WRS_ROW').getInfo()) #Image tile id
                 imageDate = ee.Date(imageTarget.get('system:time_start')).format("YYYY-MM-dd").getInfo()
@@ -115,9 +145,6 @@ def start_processing(imageSource,satellite,regionName,boaFolder,exportFolder,dat
             imageScale = 10 # Sentinel resolution
         else:
             imageScale = 30 # Landsat resolution
-        
-        ## Region of interest:
-        aoi = regions.filter(ee.Filter.eq('name',regionName))
 
 
         ###########################    CLOUD MASK    #############################
@@ -138,7 +165,7 @@ def start_processing(imageSource,satellite,regionName,boaFolder,exportFolder,dat
 
         ## Apply land mask
         #landMask = landMaskFunction(imageTarget, land) ## Use if Land is a featureCollection
-        landMask = imageTarget.updateMask(land.max()) ## Use if Land is an imageCollection
+        landMask = imageTarget.updateMask(landMax) ## Use if Land is an imageCollection
 
 
         ###################   MASK TIDAL FLATS & TURBIDITY  ######################
@@ -165,7 +192,7 @@ def start_processing(imageSource,satellite,regionName,boaFolder,exportFolder,dat
         #ndwiMask = tidalMask(landMask,nir,green)
         
         ## Apply turbidity mask for the whole image
-        #finalMask = turbidityMask(ndwiMask,imageGeometry,nir,swir,blue,land)
+        #finalMask = turbidityMask(ndwiMask,imageGeometry,nir,swir,blue,landMax)
         #finalMask = landMask
                 
         print('   Image masked...')
@@ -174,9 +201,8 @@ def start_processing(imageSource,satellite,regionName,boaFolder,exportFolder,dat
         ####################    WATER COLUMN CORRECTION    #######################    
         
         if dii == 1:
-          ## Filter sand polygons by tile/area:
-          #sand = ee.FeatureCollection(sand_areas).flatten().filterBounds(imageGeometry)
-          sand = ee.FeatureCollection(sand_areas).filterBounds(imageGeometry)
+          ## Sand polygons of the tile (see planner.tileArtifacts) filtered by image footprint:
+          sand = tileCache[tile]['sand'].filterBounds(imageGeometry)
 
           ## Run the Depth-Invariant Index Function
           imageDII = DII(landMask, imageScale, sand)
@@ -212,8 +238,8 @@ def start_processing(imageSource,satellite,regionName,boaFolder,exportFolder,dat
         # 2: Seagrass
         # 3: Sparse seagrass //if available
 
-        ## Filter ground points by AOI and display classes
-        filterPoints = ee.FeatureCollection(groundPoints).filterBounds(aoi).filterBounds(imageGeometry)
+        ## Ground points of the tile (see planner.tileArtifacts) filtered by image footprint
+        filterPoints = tileCache[tile]['points'].filterBounds(imageGeometry)
 
 
         ###################   CLIP TO REGION & APPLY MASKS   #####################
@@ -227,7 +253,7 @@ def start_processing(imageSource,satellite,regionName,boaFolder,exportFolder,dat
         if flat == 1:
           imageClassify = tidalMask(imageClassify,nir,green)
         if turbid == 1:
-          imageClassify = turbidityMask(imageClassify,aoi,nir,swir,blue,land)
+          imageClassify = turbidityMask(imageClassify,aoi,nir,swir,blue,landMax)
         
         ## Add bands of interest to sample training points.
         imageClassify = imageClassify.select(bandsClass)
@@ -253,12 +279,30 @@ def start_processing(imageSource,satellite,regionName,boaFolder,exportFolder,dat
             'properties': ['class'],
             'scale': imageScale})
 
-        ## Add random numbers to each feature (from 0 to 1).
-        randomData = samplingData.randomColumn("random",0)
+        if sampleCache:
+            ## Only the new or moved points are sampled; the classifier is
+            ## trained and validated on the cached table instead of sampling all points again
+            maskConfig = {'cloud': cloud, 'dii': dii, 'flat': flat, 'turbid': turbid, 'region': regionName,
+                          'sand': sand.aggregate_array('system:index') if dii == 1 else None}
+            features, labels, _, sampled = cachedSamples(imageClassify, filterPoints, bandsClass, imageID,
+                                                         smoothStr, imageScale, sampleCache, maskConfig)
+            print('    Points sampled (not in cache): ',sampled)
+            samplingData = tableCollection(features, labels, bandsClass)
+
+        if folds > 1:
+            ## K-fold mode: every point is validated once (out of fold), so the
+            ## exported classifier is trained with all of them.
+            if not sampleCache:
+                features, labels = featureTable(samplingData, bandsClass)
+            trainingData = samplingData
+            validationData = samplingData
+        else:
+            ## Add random numbers to each feature (from 0 to 1).
+            randomData = samplingData.randomColumn("random",0)
 
-        ## Split ground data in training (~70%) and validation (~30%) points
-        trainingData = randomData.filter(ee.Filter.lt("random",0.7))
-        validationData = randomData.filter(ee.Filter.gte("random", 0.7))
+            ## Split ground data in training (~70%) and validation (~30%) points
+            trainingData = randomData.filter(ee.Filter.lt("random",0.7))
+            validationData = randomData.filter(ee.Filter.gte("random", 0.7))
 
 
         ####################    TRAIN MODELS AND CLASSIFY    #####################
@@ -287,41 +331,54 @@ def start_processing(imageSource,satellite,regionName,boaFolder,exportFolder,dat
 
         #######################    TRAINING ACCURACIES    ########################
         print('   Getting accuracies...')
-        ## Get a confusion matrix representing resubstitution accuracy.
+        ## Labels and predictions of the training points (resubstitution) and of the
+        ## validation points are fetched in a single request. Confusion matrices and
+        ## accuracies are then computed locally (see metrics.py).
         ## {Resubstitution error is the error of a model on the training data.}
-        ## Axis 0 (first level) of the matrix correspond to the input classes (columns), 
-        ## and axis 1 (second level) to the output classes (rows).
-        matrixTrainingSVM = trainSVM.confusionMatrix()
+        ## Axis 0 (the rows) of the matrix correspond to the actual values, 
+        ## and Axis 1 (the columns) to the predicted values.
+        errorMx = ['class', 'classification']
+        labelPairs = {'training': trainingData.classify(trainSVM)\
+                          .reduceColumns(ee.Reducer.toList(2), errorMx).get('list')}
+        if folds <= 1:
+            labelPairs['validation'] = validationData.classify(trainSVM)\
+                          .reduceColumns(ee.Reducer.toList(2), errorMx).get('list')
+        labelPairs = ee.Dictionary(labelPairs).getInfo()
 
+        trainingPairs = np.asarray(labelPairs['training'], dtype=int).reshape(-1, 2)
 
-        #######################    VALIDATION ACCURACIES    ######################
 
-        ## Calculate accuracy using validation data
-        ## Classify the image using the trained classifier
-        validationSVM = validationData.classify(trainSVM)
+        #######################    VALIDATION ACCURACIES    ######################
 
-        ## Get a confusion matrix representing expected accuracy (Using validation points - 30%), where:
+        ## Get a confusion matrix representing expected accuracy, where:
         #  0: Softbottom
         #  1: Hardbottom
         #  2: Dense Seagrass
         #  3: Spare Seagrass
+        if folds > 1:
+            ## Train and validate the k folds concurrently on the sampled table.
+            ## Accuracies are the mean across folds, the matrix is pooled out of fold.
+            print('   Cross-validating ('+str(folds)+' folds)...')
+            cvSVM = crossValidate(features, labels, folds, stratified)
+            validationPairs = trainingPairs
+            errorMatrixSVM = cvSVM['matrix']
+            accuracySVM = {key: cvSVM[key][0] for key in ['accuracy','producer','user','kappa']}
+            print('    Accuracy (mean, std): ',cvSVM['accuracy'])
+        else:
+            ## Using validation points - 30%
+            validationPairs = np.asarray(labelPairs['validation'], dtype=int).reshape(-1, 2)
+            errorMatrixSVM = confusionMatrix(validationPairs[:,0], validationPairs[:,1])
+            accuracySVM = accuracies(errorMatrixSVM)
 
-        ## Axis 0 (the rows) of the matrix correspond to the actual values, 
-        ## and Axis 1 (the columns) to the predicted values.
-        errorMx = {'actual': 'class', 'predicted': 'classification'}
-        errorMatrixSVM = validationSVM.errorMatrix(**errorMx)
+        ## Keep the matrix to summarize the whole imageList at the end
+        campaignImages.append(imageID)
+        campaignMatrices.append(errorMatrixSVM)
 
 
         ####################    USER/PRODUCER ACCURACIES    ######################
 
-        ## Estimate user and producer accuracies
-        producerAccuracySVM = errorMatrixSVM.producersAccuracy()
-
-        # USER
-        userAccuracySVM = errorMatrixSVM.consumersAccuracy()
-
-        print('    Producer accuracy [Seagrass]: ',producerAccuracySVM.get([2,0]).getInfo())
-        print('    User accuracy [Seagrass]: ',userAccuracySVM.get([0,2]).getInfo())
+        print('    Producer accuracy [Seagrass]: ',accuracySVM['producer'][2])
+        print('    User accuracy [Seagrass]: ',accuracySVM['user'][2])
 
 
         #######################    KAPPA COEFFICIENTS    #########################
@@ -333,8 +390,7 @@ def start_processing(imageSource,satellite,regionName,boaFolder,exportFolder,dat
         # the classification is no better than a random classification. A negative number 
         # indicates the classification is significantly worse than random. A value close to 1 
         # indicates that the classification is significantly better than random.
-        kappaSVM = errorMatrixSVM.kappa()
-        print('    Kappa: ',kappaSVM.getInfo())
+        print('    Kappa: ',accuracySVM['kappa'])
 
 
         ####################    EXPORT CLASSIFIED IMAGES    ######################
@@ -350,8 +406,9 @@ def start_processing(imageSource,satellite,regionName,boaFolder,exportFolder,dat
         ## Select classified image
         output_image = ee.Image(classifiedSVM)
 
-        # set some properties for exported image:
-        output = output_image.set({'country': regionCountry,
+        # set some properties for exported image (also used as attributes
+        # of local outputs, see writer.ChunkWriter):
+        properties = {'country': regionCountry,
                        'state': state,
                        'location': regionName,
                        'name_code': nameCode,
@@ -362,7 +419,8 @@ def start_processing(imageSource,satellite,regionName,boaFolder,exportFolder,dat
                        'year': imageDate[0:4],
                        'classifier': method,
                        'generator': 'Lizcano-Sandoval'
-                            })
+                            }
+        output = output_image.set(properties)
 
         # define YOUR assetID. (This do not create folders, you need to create them manually)
         assetID = 'users/lizcanosandoval/Seagrass/'+sat+'/'+exportFolder+'/' ##This goes to an ImageCollection folder
@@ -384,74 +442,327 @@ def start_processing(imageSource,satellite,regionName,boaFolder,exportFolder,dat
 
         ###############    SAVE MATRICES TO WORKING DIRECTORY    #################
         print('   Saving matrices to working directory...')
-        # Extract values from each matrix
-        SVM_trainingMatrix = matrixTrainingSVM.array().getInfo()
-        SVM_trainingAccuracy = matrixTrainingSVM.accuracy().getInfo()
-        SVM_errorMatrix = errorMatrixSVM.array().getInfo()
-        SVM_errorAccuracy = errorMatrixSVM.accuracy().getInfo()
-        SVM_producerAccuracy = producerAccuracySVM.getInfo()
-        SVM_userAccuracy = userAccuracySVM.getInfo()
-        SVM_kappa = kappaSVM.getInfo()
-
-
-        ## Convert matrices to pandas dataframes:
-        #Training Matrices
-        rowIndex = {0:'Sb', 1:'Hb', 2:'Dn', 3:'Sp'}
-        TM_SVM = pd.DataFrame(SVM_trainingMatrix).rename(columns=rowIndex, index=rowIndex)
-        TM_concat = pd.concat([TM_SVM], keys=['SVM'])
-
-        #Training Accuracies
-        TA_SVM = pd.Series(SVM_trainingAccuracy)
-        TA_concat = pd.DataFrame(pd.concat([TA_SVM],ignore_index=True), columns=(['Tr_Accuracy']))\
-                        .rename({0:'SVM'})
-
-        #Validation-Error Matrices
-        VM_SVM = pd.DataFrame(SVM_errorMatrix).rename(columns=rowIndex, index=rowIndex)
-        VM_concat = pd.concat([VM_SVM], keys=['SVM'])
-
-        #Validation Accuracies
-        VA_SVM = pd.Series(SVM_errorAccuracy)
-        VA_concat = pd.DataFrame(pd.concat([VA_SVM],ignore_index=True), columns=(['Va_Accuracy']))\
-                        .rename({0:'SVM'})
-
-        #Producer-User Accuracies
-        ## Create a pandas dataframe with producer and user accuracies:
-        dfPA_SVM = pd.DataFrame(producerAccuracySVM.getInfo(), columns=['Producer'])
-        dfUA_SVM = pd.DataFrame(userAccuracySVM.getInfo()).transpose()
-
-        PU_SVM = pd.concat([dfPA_SVM, dfUA_SVM.rename(columns={0:'User'})], axis=1).rename(index=rowIndex)
-        PU_concat = pd.concat([PU_SVM], keys=['SVM'])
-
-        # Kappa coefficients
-        Kp_SVM = pd.Series(SVM_kappa)
-        Kp_concat = pd.DataFrame(pd.concat([Kp_SVM],ignore_index=True), columns=(['Kappa']))\
-                        .rename({0:'SVM'})
-
-        # Extract the number of training and validation points per class:
-        trainingInfo = trainingData.aggregate_histogram('class').getInfo()
-        validationInfo = validationData.aggregate_histogram('class').getInfo()
-
-        traSeries = pd.Series(trainingInfo)
-        valSeries = pd.Series(validationInfo)
-
-        Points_concat = pd.DataFrame(pd.concat([traSeries, valSeries],ignore_index=True,axis=1))\
-                        .rename(columns={0:'TraPoints',1:'ValPoints'}).rename({'0':'Sb','1':'Hb','2':'Dn'},axis='index')
-
-        # Organize each matrix in separate excel sheets
         excelName = 'Mrx'+ smoothStr + imageID + '_' + nameCode +'.xlsx'
         excelDir = '/content/drive/My Drive/FromGEE/Matrices/'+excelName
-        excel = pd.ExcelWriter(excelDir, engine='xlsxwriter')
-
-        Points_concat.to_excel(excel, sheet_name='Points', index=True, startrow=0)
-        TM_concat.to_excel(excel, sheet_name='TrMrx', index=True, startrow=0)
-        TA_concat.to_excel(excel, sheet_name='TrAcc', index=True, startrow=0)
-        VM_concat.to_excel(excel, sheet_name='VaMrx', index=True, startrow=0)
-        VA_concat.to_excel(excel, sheet_name='VaAcc', index=True, startrow=0)
-        PU_concat.to_excel(excel, sheet_name='PU-Mrx', index=True, startrow=0)
-        Kp_concat.to_excel(excel, sheet_name='Kappa', index=True, startrow=0)
-
-        # Save matrices as .xlsx file:
-        excel.close()
+        save_matrices(excelDir, trainingPairs, validationPairs, errorMatrixSVM, accuracySVM,
+                      cvSVM if folds > 1 else None)
         print('   Saved Matrices of '+imageID)
 
+    if not campaignMatrices:
+        print('NO SCENES PROCESSED: no accuracy report saved.')
+        return deferred
+
+    ## Accuracies of all images computed in one batch and saved in a single sheet
+    report = batchReport(campaignImages, np.stack(campaignMatrices))
+    excelDir = '/content/drive/My Drive/FromGEE/Matrices/Acc'+ smoothStr + nameCode +'.xlsx'
+    excel = pd.ExcelWriter(excelDir, engine='xlsxwriter')
+    report.to_excel(excel, sheet_name='SVM', index=True, startrow=0)
+    excel.close()
+
     print('ALL IMAGES HAVE BEEN CLASSIFIED!')
+    return deferred
+
+
+
+def start_collection(imageSource,satellite,regionName,boaFolder,exportFolder,dataFolder,smoothStr,
+                     nameCode,regionCountry,state,imageList,sand_areas,groundPoints,land,regions,cloud,dii,flat,turbid,screen=None,
+                     defer=False):
+    """
+    Collection mode of start_processing, with the same arguments (see start_processing).
+
+    The per-image pipeline is written once as a function mapped over an ImageCollection
+    built from imageList, so the graph built in Python and the number of requests stay
+    flat as the list grows:
+      - one request gets the metadata and the training/validation labels of all images,
+        and the matrices and accuracies are computed locally in one batch (see metrics.py);
+      - the exports are started from the same mapped collection.
+    Images can be pre-screened with screen and defer, as in start_processing, and the
+    deferred image IDs are returned.
+    All images must be from the satellite given in satellite. The k-fold mode (folds) of
+    start_processing is not available in this mode.
+    """
+
+    import numpy as np
+    import pandas as pd
+    import xlsxwriter
+    from functions import applyScaleFactors,CloudScore6S,tidalMask,turbidityMask,DII
+    from metrics import confusionMatrices,accuracies,batchReport
+    from planner import collectionPath
+    from screening import screenScenes
+
+    from google.colab import auth
+    auth.authenticate_user()
+
+    import google
+    SCOPES = ['https://www.googleapis.com/auth/cloud-platform', 'https://www.googleapis.com/auth/earthengine']
+    CREDENTIALS, project_id = google.auth.default(default_scopes=SCOPES)
+
+    import ee
+    ee.Initialize(CREDENTIALS, project='earth-engine-252816')
+
+
+    print('Initiating...')
+
+    ## Region of interest and land mask, the same for all images
+    aoi = regions.filter(ee.Filter.eq('name',regionName))
+    landMax = land.max()
+
+    ## Collection of the images in imageList (duplicated IDs are dropped)
+    imageIDs = list(dict.fromkeys(imageList))
+    deferred = []
+    if screen is not None:
+        imageIDs, skipped, checks = screenScenes(imageIDs, imageSource, satellite, boaFolder, aoi,
+                                                 sand_areas, groundPoints, screen if dii == 1 else dict(screen, sand=None), defer)
+        deferred = [imageID for imageID, (status, reason) in skipped.items() if status == 'deferred']
+    collection = ee.ImageCollection(collectionPath(imageSource, satellite, boaFolder).rstrip('/'))\
+                   .filter(ee.Filter.inList('system:index', imageIDs))
+
+    ## Settings that only depend on the satellite
+    if 'Sentinel' in satellite:
+        imageScale = 10 # Sentinel resolution
+        nir, green, swir, blue = 'B8', 'B3', 'B11', 'B2'
+        bandsClass = ['B1','B2','B3','B4']
+        bg = ['B2B3']
+    elif 'Landsat8' in satellite:
+        imageScale = 30 # Landsat resolution
+        nir, green, swir, blue = 'SR_B5', 'SR_B3', 'SR_B6', 'SR_B2'
+        bandsClass = ['SR_B1','SR_B2','SR_B3','SR_B4']
+        bg = ['B2B3']
+    else:
+        imageScale = 30 # Landsat resolution
+        nir, green, swir, blue = 'SR_B4', 'SR_B2', 'SR_B5', 'SR_B1'
+        bandsClass = ['SR_B1','SR_B2','SR_B3']
+        bg = ['B1B2']
+    if dii == 1:
+        bandsClass = bandsClass + bg
+    method = 'SVM'
+    errorMx = ['class', 'classification']
+
+
+    ######################   PER-IMAGE PIPELINE (SERVER-SIDE)   #################
+    ## Everything below is built once and mapped over the collection.
+    def pipeline(image):
+        image = ee.Image(image)
+        imageGeometry = image.geometry()
+
+        ## Scale factors and metadata
+        imageTarget = applyScaleFactors(image, imageSource, satellite)
+        if 'assets' == imageSource:
+            imageSat = image.get('satellite')
+            imageTile = ee.String(image.get('tile_id'))
+            imageDate = ee.String(image.get('date'))
+        elif 'Sentinel' in satellite:
+            imageSat = image.get('SPACECRAFT_NAME')
+            imageTile = ee.String(image.get('MGRS_TILE'))
+            imageDate = ee.Date(image.get('GENERATION_TIME')).format('YYYY-MM-dd HH:mm:ss')
+        else:
+            imageSat = satellite
+            imageTile = ee.Number(image.get('WRS_PATH')).format('%d').cat(ee.Number(image.get('WRS_ROW')).format('%d'))
+            imageDate = ee.Date(image.get('system:time_start')).format('YYYY-MM-dd')
+
+        ## Masks
+        if cloud == 1:
+            imageTarget = CloudScore6S(satellite, imageTarget, 5)
+        landMask = imageTarget.updateMask(landMax)
+
+        ## Water column correction
+        if dii == 1:
+            sand = ee.FeatureCollection(sand_areas).filterBounds(imageGeometry)
+            imageDII = DII(landMask, imageScale, sand)
+            finalImage = landMask.addBands(imageDII.select(bg))
+        else:
+            finalImage = landMask
+
+        ## Clip to region & apply masks
+        imageClassify = finalImage.clip(aoi)
+        if flat == 1:
+            imageClassify = tidalMask(imageClassify,nir,green)
+        if turbid == 1:
+            imageClassify = turbidityMask(imageClassify,aoi,nir,swir,blue,landMax)
+        imageClassify = imageClassify.select(bandsClass)
+        if 'smooth' in smoothStr:
+            imageClassify = imageClassify.convolve(ee.Kernel.euclidean(**{
+                'radius': 1, 'units': 'pixels', 'normalize': True}))
+
+        ## Training and validation data
+        filterPoints = ee.FeatureCollection(groundPoints).filterBounds(aoi).filterBounds(imageGeometry)
+        samplingData = imageClassify.sampleRegions(**{
+            'collection': filterPoints,
+            'properties': ['class'],
+            'scale': imageScale})
+        randomData = samplingData.randomColumn("random",0)
+        trainingData = randomData.filter(ee.Filter.lt("random",0.7))
+        validationData = randomData.filter(ee.Filter.gte("random", 0.7))
+
+        ## Train and classify
+        trainSVM = ee.Classifier.libsvm(**{'kernelType': 'RBF', 'gamma': 100, 'cost': 100})\
+                     .train(**{'features': trainingData, 'classProperty': 'class', 'inputProperties': bandsClass})
+        classifiedSVM = imageClassify.classify(trainSVM).reproject(**{'crs': 'EPSG:4326', 'scale': imageScale})
+
+        output = classifiedSVM.set({'country': regionCountry,
+                                    'state': state,
+                                    'location': regionName,
+                                    'name_code': nameCode,
+                                    'satellite': imageSat,
+                                    'tile_id': imageTile,
+                                    'image_id': image.get('system:index'),
+                                    'date': imageDate,
+                                    'year': imageDate.slice(0,4),
+                                    'classifier': method,
+                                    'generator': 'Lizcano-Sandoval'})
+        stats = ee.Feature(None, {
+            'image_id': image.get('system:index'),
+            'tile_id': imageTile,
+            'date': imageDate,
+            'training': trainingData.classify(trainSVM).reduceColumns(ee.Reducer.toList(2), errorMx).get('list'),
+            'validation': validationData.classify(trainSVM).reduceColumns(ee.Reducer.toList(2), errorMx).get('list')})
+        return output, stats
+
+    classified = collection.map(lambda image: pipeline(image)[0])
+    statistics = ee.FeatureCollection(collection.map(lambda image: pipeline(image)[1]))
+
+
+    ##################    ACCURACIES OF ALL IMAGES (ONE REQUEST)    ############
+    print('Training models and getting accuracies of '+str(len(imageIDs))+' images...')
+    features = statistics.getInfo()['features']
+    names = [f['properties']['image_id'] for f in features]
+    if not names:
+        print('NO SCENES PROCESSED: no image exported, no accuracy report saved.')
+        return deferred
+    training = [np.asarray(f['properties']['training'], dtype=int).reshape(-1, 2) for f in features]
+    validation = [np.asarray(f['properties']['validation'], dtype=int).reshape(-1, 2) for f in features]
+
+    ## All validation matrices in one batch (N x 4 x 4)
+    imageIndex = np.concatenate([np.full(len(v), n) for n, v in enumerate(validation)])
+    pairs = np.concatenate(validation)
+    errorMatrices = confusionMatrices(pairs[:,0], pairs[:,1], imageIndex, len(names))
+    accuracy = accuracies(errorMatrices)
+
+
+    ####################    EXPORT CLASSIFIED IMAGES    ######################
+    if 'Sentinel' in satellite:
+        sat = 'Sentinel'
+    else:
+        sat = 'Landsat'
+    assetID = 'users/lizcanosandoval/Seagrass/'+sat+'/'+exportFolder+'/' ##This goes to an ImageCollection folder
+
+    for i, imageID in enumerate(names):
+        print('Image '+imageID+' (tile '+str(features[i]['properties']['tile_id'])+')')
+        print('    Producer accuracy [Seagrass]: ',accuracy['producer'][i][2])
+        print('    User accuracy [Seagrass]: ',accuracy['user'][i][2])
+        print('    Kappa: ',accuracy['kappa'][i])
+
+        output = ee.Image(classified.filter(ee.Filter.eq('system:index', imageID)).first())
+        imageGeometry = ee.Image(collection.filter(ee.Filter.eq('system:index', imageID)).first()).geometry()
+        fileName = imageID+smoothStr+ method +'_'+nameCode
+        ee.batch.Export.image.toAsset(\
+            image = output,
+            description = method +smoothStr+ imageID,
+            assetId = assetID + fileName,
+            region = imageGeometry.buffer(10),
+            maxPixels = 1e13,
+            crs = 'EPSG:4326',
+            scale = imageScale).start()
+        print('   Classified Image '+str(i+1)+': '+fileName+' submitted...')
+
+        excelName = 'Mrx'+ smoothStr + imageID + '_' + nameCode +'.xlsx'
+        excelDir = '/content/drive/My Drive/FromGEE/Matrices/'+excelName
+        save_matrices(excelDir, training[i], validation[i], errorMatrices[i],
+                      {key: value[i] for key, value in accuracy.items()})
+
+    ## Accuracies of all images in a single sheet
+    report = batchReport(names, errorMatrices)
+    excelDir = '/content/drive/My Drive/FromGEE/Matrices/Acc'+ smoothStr + nameCode +'.xlsx'
+    excel = pd.ExcelWriter(excelDir, engine='xlsxwriter')
+    report.to_excel(excel, sheet_name='SVM', index=True, startrow=0)
+    excel.close()
+
+    print('ALL IMAGES HAVE BEEN CLASSIFIED!')
+    return deferred
+
+def save_matrices(excelDir, trainingPairs, validationPairs, errorMatrixSVM, accuracySVM, cvSVM=None):
+    """
+    Save the training/validation matrices and accuracies of one image in an excel file.
+    ----------------------------------
+    excelDir (str)        = path of the .xlsx file.
+    trainingPairs (array) = (points x 2) actual and predicted classes of the training points.
+    validationPairs (array) = (points x 2) actual and predicted classes of the validation points.
+    errorMatrixSVM (array)= validation confusion matrix (see metrics.confusionMatrix).
+    accuracySVM (dict)    = validation accuracies (see metrics.accuracies).
+    cvSVM (dict)          = cross-validation results (see validation.crossValidate), if any.
+    """
+
+    import numpy as np
+    import pandas as pd
+    import xlsxwriter
+    from metrics import rowIndex,confusionMatrix,accuracies
+
+    # Extract values from each matrix
+    SVM_trainingMatrix = confusionMatrix(trainingPairs[:,0], trainingPairs[:,1])
+    SVM_trainingAccuracy = accuracies(SVM_trainingMatrix)['accuracy']
+    SVM_errorMatrix = errorMatrixSVM
+    SVM_errorAccuracy = accuracySVM['accuracy']
+    SVM_producerAccuracy = accuracySVM['producer']
+    SVM_userAccuracy = accuracySVM['user']
+    SVM_kappa = accuracySVM['kappa']
+
+
+    ## Convert matrices to pandas dataframes:
+    #Training Matrices
+    TM_SVM = pd.DataFrame(SVM_trainingMatrix).rename(columns=rowIndex, index=rowIndex)
+    TM_concat = pd.concat([TM_SVM], keys=['SVM'])
+
+    #Training Accuracies
+    TA_SVM = pd.Series(SVM_trainingAccuracy)
+    TA_concat = pd.DataFrame(pd.concat([TA_SVM],ignore_index=True), columns=(['Tr_Accuracy']))\
+                    .rename({0:'SVM'})
+
+    #Validation-Error Matrices
+    VM_SVM = pd.DataFrame(SVM_errorMatrix).rename(columns=rowIndex, index=rowIndex)
+    VM_concat = pd.concat([VM_SVM], keys=['SVM'])
+
+    #Validation Accuracies
+    VA_SVM = pd.Series(SVM_errorAccuracy)
+    VA_concat = pd.DataFrame(pd.concat([VA_SVM],ignore_index=True), columns=(['Va_Accuracy']))\
+                    .rename({0:'SVM'})
+
+    #Producer-User Accuracies
+    ## Create a pandas dataframe with producer and user accuracies:
+    PU_SVM = pd.DataFrame({'Producer': SVM_producerAccuracy, 'User': SVM_userAccuracy}).rename(index=rowIndex)
+    PU_concat = pd.concat([PU_SVM], keys=['SVM'])
+
+    # Kappa coefficients
+    Kp_SVM = pd.Series(SVM_kappa)
+    Kp_concat = pd.DataFrame(pd.concat([Kp_SVM],ignore_index=True), columns=(['Kappa']))\
+                    .rename({0:'SVM'})
+
+    # Extract the number of training and validation points per class:
+    traSeries = pd.Series(np.bincount(trainingPairs[:,0], minlength=len(rowIndex)))
+    valSeries = pd.Series(np.bincount(validationPairs[:,0], minlength=len(rowIndex)))
+
+    Points_concat = pd.DataFrame(pd.concat([traSeries, valSeries],ignore_index=True,axis=1))\
+                    .rename(columns={0:'TraPoints',1:'ValPoints'}).rename(rowIndex,axis='index')
+
+    # Organize each matrix in separate excel sheets
+    excel = pd.ExcelWriter(excelDir, engine='xlsxwriter')
+
+    Points_concat.to_excel(excel, sheet_name='Points', index=True, startrow=0)
+    TM_concat.to_excel(excel, sheet_name='TrMrx', index=True, startrow=0)
+    TA_concat.to_excel(excel, sheet_name='TrAcc', index=True, startrow=0)
+    VM_concat.to_excel(excel, sheet_name='VaMrx', index=True, startrow=0)
+    VA_concat.to_excel(excel, sheet_name='VaAcc', index=True, startrow=0)
+    PU_concat.to_excel(excel, sheet_name='PU-Mrx', index=True, startrow=0)
+    Kp_concat.to_excel(excel, sheet_name='Kappa', index=True, startrow=0)
+
+    # Cross-validation mean and spread across folds
+    if cvSVM is not None:
+        classes = [rowIndex[c] for c in range(len(cvSVM['producer'][0]))]
+        CV_SVM = pd.DataFrame({
+            'Mean': [cvSVM['accuracy'][0], cvSVM['kappa'][0]] + list(cvSVM['producer'][0]) + list(cvSVM['user'][0]),
+            'Std': [cvSVM['accuracy'][1], cvSVM['kappa'][1]] + list(cvSVM['producer'][1]) + list(cvSVM['user'][1])},
+            index=['Accuracy','Kappa'] + ['Producer_'+c for c in classes] + ['User_'+c for c in classes])
+        CV_concat = pd.concat([CV_SVM], keys=['SVM'])
+        CV_concat.to_excel(excel, sheet_name='CV-'+str(cvSVM['folds']), index=True, startrow=0)
+
+    # Save matrices as .xlsx file:
+    excel.close()
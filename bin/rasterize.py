@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+"""
+Polygon rasterizer for local clipping and land masking.
+
+Feature collections (GeoJSON dictionaries, e.g. from getInfo() on the
+regions, Florida_10m or the seagrass buffer) are turned into pixel masks on
+the grid of a scene with a scanline fill. The crossings of all edges with
+all pixel rows are computed at once with NumPy, so the cost of a detailed
+coastline is a few array operations. Masks are cached by (geometry hash,
+grid), least recently used first out, so clipping many scenes of the same
+grid reuses the mask.
+"""
+
+import os
+import json
+import hashlib
+import collections
+import numpy as np
+from common import atomicWrite
+
+## Masks already rasterized in this session: key -> bool array (read-only),
+## least recently used first, within MASK_CACHE_BYTES
+_masks = collections.OrderedDict()
+MASK_CACHE_BYTES = 1 << 30
+
+
+## Rings of every polygon in a GeoJSON FeatureCollection, Feature or geometry.
+## Returns a list of polygons, each a list of rings (n x 2 arrays).
+def _polygons(geometry):
+    kind = geometry.get('type')
+    if kind == 'FeatureCollection':
+        return [p for feature in geometry['features'] for p in _polygons(feature)]
+    if kind == 'Feature':
+        return _polygons(geometry['geometry'])
+    if kind == 'GeometryCollection':
+        return [p for g in geometry['geometries'] for p in _polygons(g)]
+    if kind == 'Polygon':
+        return [[np.asarray(ring, dtype=np.float64)[:, :2] for ring in geometry['coordinates']]]
+    if kind == 'MultiPolygon':
+        return [[np.asarray(ring, dtype=np.float64)[:, :2] for ring in polygon]
+                for polygon in geometry['coordinates']]
+    ## Points and lines cover no pixel
+    return []
+
+
+# =============================================================================
+# Function to rasterize polygons on a grid.
+
+## Usage:
+# geometry = GeoJSON dictionary (FeatureCollection, Feature or geometry) in the
+#            coordinates of the grid, e.g. regions.filter(...).getInfo().
+# shape = (rows, cols) of the grid.
+# transform = affine geotransform [x0, dx, 0, y0, 0, dy] of the grid.
+# chunkRows = rows filled at a time.
+
+## Output:
+# bool array (rows x cols), True where the pixel center is inside a polygon
+# (even-odd rule, so holes are left out).
+# =============================================================================
+def rasterize(geometry, shape, transform, chunkRows=2048):
+    rows, cols = shape
+    x0, dx, _, y0, _, dy = transform
+    mask = np.zeros(shape, dtype=bool)
+
+    ## All edges in pixel coordinates, tagged with their polygon
+    edges, owner = [], []
+    for p, polygon in enumerate(_polygons(geometry)):
+        for ring in polygon:
+            if not np.array_equal(ring[0], ring[-1]):
+                ring = np.vstack([ring, ring[:1]])
+            ring = np.stack([(ring[:, 0] - x0) / dx, (ring[:, 1] - y0) / dy], axis=1)
+            edges.append(np.concatenate([ring[:-1], ring[1:]], axis=1))
+            owner.append(np.full(len(ring) - 1, p))
+    if not edges:
+        return mask
+    edges = np.concatenate(edges)
+    owner = np.concatenate(owner)
+
+    ## Rows whose center (r + 0.5) is crossed by each edge (half-open, so a
+    ## vertex shared by two edges is counted once)
+    ya, yb = np.minimum(edges[:, 1], edges[:, 3]), np.maximum(edges[:, 1], edges[:, 3])
+    first = np.clip(np.ceil(ya - 0.5), 0, rows).astype(np.int64)
+    last = np.clip(np.ceil(yb - 0.5), 0, rows).astype(np.int64)
+    n = last - first
+    keep = n > 0
+    edges, owner, first, n = edges[keep], owner[keep], first[keep], n[keep]
+
+    ## One crossing per (edge, row)
+    edge = np.repeat(np.arange(len(edges)), n)
+    row = np.repeat(first, n) + (np.arange(n.sum()) - np.repeat(np.cumsum(n) - n, n))
+    xa, ya, xb, yb = edges[edge].T
+    x = xa + (row + 0.5 - ya) * (xb - xa) / (yb - ya)
+
+    ## Pair the crossings of each polygon on each row: (1st, 2nd), (3rd, 4th)...
+    order = np.lexsort((x, row, owner[edge]))
+    row, x = row[order][0::2], np.stack([x[order][0::2], x[order][1::2]], axis=1)
+    start = np.clip(np.ceil(x[:, 0] - 0.5), 0, cols).astype(np.int64)
+    stop = np.clip(np.ceil(x[:, 1] - 0.5), 0, cols).astype(np.int64)
+    spans = stop > start
+    row, start, stop = row[spans], start[spans], stop[spans]
+
+    ## Fill the spans with a difference array, a band of rows at a time.
+    ## Overlapping polygons add up, so the result is their union.
+    for band in range(0, rows, chunkRows):
+        inBand = (row >= band) & (row < band + chunkRows)
+        h = min(chunkRows, rows - band)
+        diff = np.zeros((h, cols + 1), dtype=np.int32)
+        np.add.at(diff, (row[inBand] - band, start[inBand]), 1)
+        np.add.at(diff, (row[inBand] - band, stop[inBand]), -1)
+        mask[band:band + h] = np.cumsum(diff[:, :cols], axis=1) > 0
+
+    return mask
+
+###############################################################################
+
+
+# =============================================================================
+# Function to get the mask of a geometry on a grid from the cache.
+
+## Usage:
+# geometry, shape, transform = as in rasterize.
+# cacheDir = optional folder to keep the masks (bit-packed) between sessions.
+
+## Output:
+# bool array (rows x cols), True inside the polygons. It is shared: do not modify it.
+# =============================================================================
+def cachedMask(geometry, shape, transform, cacheDir=None):
+    digest = hashlib.sha1(json.dumps(geometry, sort_keys=True).encode())
+    digest.update(repr((tuple(shape), tuple(float(v) for v in transform))).encode())
+    key = digest.hexdigest()
+    if key in _masks:
+        _masks.move_to_end(key)
+        return _masks[key]
+
+    name = os.path.join(cacheDir, 'mask_'+key+'.npy') if cacheDir else None
+    if name and os.path.exists(name):
+        mask = np.unpackbits(np.load(name), axis=1, count=shape[1]).view(bool)
+    else:
+        mask = rasterize(geometry, shape, transform)
+        if name:
+            os.makedirs(cacheDir, exist_ok=True)
+            atomicWrite(name, lambda tmp: np.save(tmp, np.packbits(mask, axis=1)))
+    mask.flags.writeable = False
+    _masks[key] = mask
+    nbytes = sum(m.nbytes for m in _masks.values())
+    while nbytes > MASK_CACHE_BYTES and len(_masks) > 1:
+        nbytes -= _masks.popitem(last=False)[1].nbytes
+    return mask
+
+###############################################################################
+
+
+# =============================================================================
+# Function to clip an image with a mask (local equivalent of image.clip(aoi)
+# and, with invert=True, of landMaskFunction).
+
+## Usage:
+# image = float array (bands x rows x cols, or rows x cols); it is masked in place.
+# mask = bool array (rows x cols), e.g. from cachedMask.
+# invert = if True, pixels inside the polygons are masked instead.
+
+## Output:
+# image with the masked pixels set to NaN.
+# =============================================================================
+def clipImage(image, mask, invert=False):
+    ## Only the dropped pixels are written, no full-size float mask
+    image[..., mask if invert else ~mask] = np.nan
+    return image
+
+###############################################################################
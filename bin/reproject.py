@@ -0,0 +1,223 @@
+# -*- coding: utf-8 -*-
+"""
+Cached reprojection of class maps to EPSG:4326.
+
+Scenes of the same MGRS tile or WRS path/row share the same source grid, so
+the nearest-neighbour map from every EPSG:4326 output pixel to its source
+pixel is computed once per (source grid, target grid), saved as .npy and
+memory-mapped afterwards. Warping a class map is then a single gather.
+Class maps are categorical, so nearest neighbour is the right resampling
+(as reproject() does by default in EE).
+
+UTM (EPSG:326xx/327xx, used by Sentinel-2 and Landsat L2) is converted with
+the transverse Mercator series of Snyder (1987); other projections need pyproj.
+"""
+
+import os
+import hashlib
+import numpy as np
+from common import NODATA,atomicWrite
+
+## WGS84 ellipsoid and UTM scale factor
+_A = 6378137.0
+_F = 1 / 298.257223563
+_E2 = _F * (2 - _F)
+_EP2 = _E2 / (1 - _E2)
+_K0 = 0.9996
+
+## Meters per degree used by EE for the scale of EPSG:4326 outputs
+DEGREE = 111319.49079327357
+
+
+## UTM zone, hemisphere of an 'EPSG:326xx' (north) or 'EPSG:327xx' (south) code.
+def _utm(crs):
+    code = int(str(crs).upper().replace('EPSG:', ''))
+    if 32601 <= code <= 32660:
+        return code - 32600, False
+    if 32701 <= code <= 32760:
+        return code - 32700, True
+    return None
+
+
+def _meridianArc(phi):
+    e2, e4, e6 = _E2, _E2 ** 2, _E2 ** 3
+    return _A * ((1 - e2 / 4 - 3 * e4 / 64 - 5 * e6 / 256) * phi
+                 - (3 * e2 / 8 + 3 * e4 / 32 + 45 * e6 / 1024) * np.sin(2 * phi)
+                 + (15 * e4 / 256 + 45 * e6 / 1024) * np.sin(4 * phi)
+                 - (35 * e6 / 3072) * np.sin(6 * phi))
+
+
+# =============================================================================
+# Functions to convert between longitude/latitude and a projected CRS.
+
+## Usage:
+# lon, lat = arrays in degrees (x, y = arrays in the units of crs).
+# crs = str, e.g. 'EPSG:32617'.
+# =============================================================================
+def fromLonLat(lon, lat, crs):
+    if str(crs).upper() == 'EPSG:4326':
+        return lon, lat
+    utm = _utm(crs)
+    if utm is None:
+        from pyproj import Transformer
+        return Transformer.from_crs('EPSG:4326', crs, always_xy=True).transform(lon, lat)
+
+    zone, south = utm
+    phi = np.radians(lat)
+    lam = np.radians(lon) - np.radians((zone - 1) * 6 - 180 + 3)
+    sin, cos, tan = np.sin(phi), np.cos(phi), np.tan(phi)
+    N = _A / np.sqrt(1 - _E2 * sin ** 2)
+    T = tan ** 2
+    C = _EP2 * cos ** 2
+    A = cos * lam
+    x = _K0 * N * (A + (1 - T + C) * A ** 3 / 6
+                   + (5 - 18 * T + T ** 2 + 72 * C - 58 * _EP2) * A ** 5 / 120) + 500000.0
+    y = _K0 * (_meridianArc(phi) + N * tan * (A ** 2 / 2 + (5 - T + 9 * C + 4 * C ** 2) * A ** 4 / 24
+               + (61 - 58 * T + T ** 2 + 600 * C - 330 * _EP2) * A ** 6 / 720))
+    if south:
+        y = y + 10000000.0
+    return x, y
+
+
+def toLonLat(x, y, crs):
+    if str(crs).upper() == 'EPSG:4326':
+        return x, y
+    utm = _utm(crs)
+    if utm is None:
+        from pyproj import Transformer
+        return Transformer.from_crs(crs, 'EPSG:4326', always_xy=True).transform(x, y)
+
+    zone, south = utm
+    if south:
+        y = y - 10000000.0
+    e1 = (1 - np.sqrt(1 - _E2)) / (1 + np.sqrt(1 - _E2))
+    mu = (y / _K0) / (_A * (1 - _E2 / 4 - 3 * _E2 ** 2 / 64 - 5 * _E2 ** 3 / 256))
+    phi1 = (mu + (3 * e1 / 2 - 27 * e1 ** 3 / 32) * np.sin(2 * mu)
+            + (21 * e1 ** 2 / 16 - 55 * e1 ** 4 / 32) * np.sin(4 * mu)
+            + (151 * e1 ** 3 / 96) * np.sin(6 * mu)
+            + (1097 * e1 ** 4 / 512) * np.sin(8 * mu))
+    sin, cos, tan = np.sin(phi1), np.cos(phi1), np.tan(phi1)
+    C1 = _EP2 * cos ** 2
+    T1 = tan ** 2
+    N1 = _A / np.sqrt(1 - _E2 * sin ** 2)
+    R1 = _A * (1 - _E2) / (1 - _E2 * sin ** 2) ** 1.5
+    D = (x - 500000.0) / (N1 * _K0)
+    phi = phi1 - (N1 * tan / R1) * (D ** 2 / 2
+                                    - (5 + 3 * T1 + 10 * C1 - 4 * C1 ** 2 - 9 * _EP2) * D ** 4 / 24
+                                    + (61 + 90 * T1 + 298 * C1 + 45 * T1 ** 2 - 252 * _EP2 - 3 * C1 ** 2) * D ** 6 / 720)
+    lam = (D - (1 + 2 * T1 + C1) * D ** 3 / 6
+           + (5 - 2 * C1 + 28 * T1 - 3 * C1 ** 2 + 8 * _EP2 + 24 * T1 ** 2) * D ** 5 / 120) / cos
+    return np.degrees(lam) + (zone - 1) * 6 - 180 + 3, np.degrees(phi)
+
+###############################################################################
+
+
+# =============================================================================
+# Function to define the EPSG:4326 grid covering a source grid.
+
+## Usage:
+# srcShape = (rows, cols) of the source grid.
+# srcTransform = affine geotransform [x0, dx, 0, y0, 0, dy] of the source grid.
+# srcCrs = str CRS of the source grid.
+# scale = output pixel size in meters, as in reproject(crs='EPSG:4326', scale=...).
+
+## Output:
+# dstShape, dstTransform of the EPSG:4326 grid. The grid is snapped to
+# multiples of the pixel size, so all scenes of a tile get the same grid.
+# =============================================================================
+def targetGrid(srcShape, srcTransform, srcCrs, scale):
+    rows, cols = srcShape
+    x0, dx, _, y0, _, dy = srcTransform
+    ## Points along the border of the source grid
+    t = np.linspace(0, 1, 101)
+    edge = np.concatenate([np.stack([t * cols, np.zeros_like(t)], 1), np.stack([t * cols, np.full_like(t, rows)], 1),
+                           np.stack([np.zeros_like(t), t * rows], 1), np.stack([np.full_like(t, cols), t * rows], 1)])
+    lon, lat = toLonLat(x0 + edge[:, 0] * dx, y0 + edge[:, 1] * dy, srcCrs)
+
+    step = scale / DEGREE
+    west, east = np.floor(lon.min() / step) * step, np.ceil(lon.max() / step) * step
+    south, north = np.floor(lat.min() / step) * step, np.ceil(lat.max() / step) * step
+    dstShape = (int(round((north - south) / step)), int(round((east - west) / step)))
+    return dstShape, [float(west), step, 0.0, float(north), 0.0, -step]
+
+###############################################################################
+
+
+# =============================================================================
+# Function to compute the nearest-neighbour warp index.
+
+## Usage:
+# srcShape, srcTransform, srcCrs = source grid (e.g. UTM grid of the tile).
+# dstShape, dstTransform = EPSG:4326 grid (e.g. from targetGrid).
+# chunkRows = output rows computed at a time.
+
+## Output:
+# int32 array (dst rows x cols) with the flat index of the source pixel
+# of every output pixel, -1 outside the source grid.
+# =============================================================================
+def warpIndex(srcShape, srcTransform, srcCrs, dstShape, dstTransform, chunkRows=512):
+    rows, cols = dstShape
+    sx0, sdx, _, sy0, _, sdy = srcTransform
+    x0, dx, _, y0, _, dy = dstTransform
+    index = np.empty(dstShape, dtype=np.int32)
+    lon = x0 + (np.arange(cols) + 0.5) * dx
+
+    for start in range(0, rows, chunkRows):
+        stop = min(start + chunkRows, rows)
+        lat = y0 + (np.arange(start, stop) + 0.5) * dy
+        x, y = fromLonLat(*np.meshgrid(lon, lat), srcCrs)
+        c = np.floor((x - sx0) / sdx).astype(np.int64)
+        r = np.floor((y - sy0) / sdy).astype(np.int64)
+        inside = (r >= 0) & (r < srcShape[0]) & (c >= 0) & (c < srcShape[1])
+        index[start:stop] = np.where(inside, r * srcShape[1] + c, -1)
+
+    return index
+
+###############################################################################
+
+
+# =============================================================================
+# Function to get the warp index of a pair of grids from the cache.
+
+## Usage:
+# cacheDir = folder of the cached warp maps.
+# other arguments as in warpIndex.
+
+## Output:
+# np.memmap (dst rows x cols), see warpIndex.
+# =============================================================================
+def cachedWarp(cacheDir, srcShape, srcTransform, srcCrs, dstShape, dstTransform):
+    grids = repr((tuple(srcShape), tuple(float(v) for v in srcTransform), str(srcCrs).upper(),
+                  tuple(dstShape), tuple(float(v) for v in dstTransform))).encode()
+    name = os.path.join(cacheDir, 'warp_'+hashlib.sha1(grids).hexdigest()+'.npy')
+    if not os.path.exists(name):
+        os.makedirs(cacheDir, exist_ok=True)
+        atomicWrite(name, lambda tmp: np.save(tmp, warpIndex(srcShape, srcTransform, srcCrs,
+                                                             dstShape, dstTransform)))
+    return np.load(name, mmap_mode='r')
+
+###############################################################################
+
+
+# =============================================================================
+# Function to warp a class map (local equivalent of reproject to EPSG:4326).
+
+## Usage:
+# classMap = uint8 array (src rows x cols).
+# index = warp index (from cachedWarp or warpIndex).
+# chunkRows = output rows gathered at a time.
+
+## Output:
+# uint8 array (dst rows x cols), NODATA outside the source grid.
+# =============================================================================
+def warp(classMap, index, chunkRows=2048):
+    source = np.ascontiguousarray(classMap).ravel()
+    out = np.empty(index.shape, dtype=source.dtype)
+    for start in range(0, index.shape[0], chunkRows):
+        idx = np.asarray(index[start:start + chunkRows])
+        block = source[np.maximum(idx, 0)]
+        block[idx < 0] = NODATA
+        out[start:start + chunkRows] = block
+    return out
+
+###############################################################################
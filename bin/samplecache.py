@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+"""
+Incremental cache of the feature samples of the ground points.
+
+Samples are kept per (scene, band list, smoothing, mask settings) in a .npz
+file, one row per point keyed by its ID and a hash of its geometry. A run
+lists the current points (ID, class, coordinates) in one request, samples
+only the points that are new or moved (one sampleRegions request on the
+filtered points) and builds the table from the cache. Labels always come
+from the current points, so a relabelled point is not sampled again. Points
+that fall on masked pixels are not cached (they are tried again on the next
+run), and points no longer in the current set are pruned from the cache.
+"""
+
+import os
+import json
+import hashlib
+import numpy as np
+from common import atomicWrite
+
+
+## Key of a point: its ID and a hash of its coordinates
+def pointKey(pointID, coordinates):
+    coordinates = np.round(np.asarray(coordinates, dtype=np.float64), 7).tolist()
+    return str(pointID)+'@'+hashlib.sha1(json.dumps(coordinates).encode()).hexdigest()[:12]
+
+
+def _cacheFile(cacheDir, scene, bandsClass, smoothStr, config):
+    group = repr((str(scene), tuple(bandsClass), 'smooth' in smoothStr,
+                  json.dumps(config, sort_keys=True, default=str))).encode()
+    return os.path.join(cacheDir, 'samples_'+hashlib.sha1(group).hexdigest()+'.npz')
+
+
+## Cached samples of a group: dictionary point key -> float32 row
+def _load(name):
+    if not os.path.exists(name):
+        return {}
+    with np.load(name) as data:
+        return dict(zip(data['keys'].tolist(), data['features']))
+
+
+def _save(name, samples, nBands):
+    keys = np.array(list(samples), dtype=str)
+    features = np.array(list(samples.values()), dtype=np.float32).reshape(-1, nBands)
+    atomicWrite(name, lambda tmp: np.savez(tmp, keys=keys, features=features))
+
+
+# =============================================================================
+# Function to get the training table of a scene, sampling only new points.
+
+## Usage:
+# image = ee.Image to sample (imageClassify in process.py).
+# points = ee.FeatureCollection of ground points (filterPoints in process.py).
+# bandsClass = list of bands to sample.
+# scene = key of the scene (the image ID).
+# smoothStr = '_smooth_' or '_raw_', as in process.py.
+# scale = sampling scale (imageScale).
+# cacheDir = folder of the cache.
+# config = dictionary of the settings that change the sampled values, e.g. the
+#          mask flags {'cloud': 1, 'dii': 1, 'flat': 0, 'turbid': 0} and the
+#          sand polygons of the DII. Values may be ee objects (e.g.
+#          sand.aggregate_array('system:index')); they are fetched with the
+#          points. Each distinct config has its own cache.
+# idProperty = property with a unique ID of the points (a moved point gets a new
+#              key from its coordinates).
+# classProperty = property with the class of the points.
+
+## Output:
+# features = float32 array (points x bands), points on masked pixels left out.
+# labels = int array (points).
+# keys = point keys (pointKey) of the rows.
+# sampled = number of points sampled in this call.
+# =============================================================================
+def cachedSamples(image, points, bandsClass, scene, smoothStr, scale, cacheDir, config=None,
+                  idProperty='system:index', classProperty='class'):
+    import ee
+
+    bandsClass = list(bandsClass)
+    config = dict(config or {})
+    ## Current points (ID, class and coordinates) and the ee values of the
+    ## config in one request
+    remote = {key: value for key, value in config.items() if isinstance(value, ee.ComputedObject)}
+    listed = ee.FeatureCollection(points).map(lambda f: ee.Feature(None, {
+        'pointID': f.get(idProperty), 'class': f.get(classProperty),
+        'coordinates': f.geometry().coordinates()}))\
+        .reduceColumns(ee.Reducer.toList(3), ['pointID', 'class', 'coordinates']).get('list')
+    fetched = ee.Dictionary({'points': listed, 'config': ee.Dictionary(remote)}).getInfo()
+    listed = fetched['points']
+    config.update(fetched['config'])
+    keys = [pointKey(pointID, coordinates) for pointID, _, coordinates in listed]
+    labels = {key: label for key, (_, label, _) in zip(keys, listed)}
+
+    name = _cacheFile(cacheDir, scene, bandsClass, smoothStr, config)
+    cached = _load(name)
+    ## Prune the points no longer in the set (removed or moved)
+    samples = {key: cached[key] for key in keys if key in cached}
+    new = {pointID: key for key, (pointID, _, _) in zip(keys, listed) if key not in samples}
+    changed = len(samples) != len(cached)
+
+    if new:
+        ## Sample the new points only, tagged with their ID
+        newPoints = ee.FeatureCollection(points).filter(ee.Filter.inList(idProperty, list(new)))\
+                      .map(lambda f: f.set('pointID', f.get(idProperty)))
+        table = image.sampleRegions(**{
+            'collection': newPoints,
+            'properties': ['pointID'],
+            'scale': scale})\
+            .reduceColumns(ee.Reducer.toList(len(bandsClass) + 1), bandsClass + ['pointID'])\
+            .get('list').getInfo()
+        ## Points on masked pixels get no row (or a null value) and are not cached
+        for row in table:
+            values = np.asarray([np.nan if v is None else v for v in row[:-1]], dtype=np.float32)
+            if not np.isnan(values).any():
+                samples[new[row[-1]]] = values
+                changed = True
+
+    if changed:
+        os.makedirs(cacheDir, exist_ok=True)
+        _save(name, samples, len(bandsClass))
+
+    keys = [key for key in keys if key in samples]
+    features = np.array([samples[key] for key in keys], dtype=np.float32).reshape(-1, len(bandsClass))
+    return features, np.array([labels[key] for key in keys], dtype=int), keys, len(new)
+
+###############################################################################
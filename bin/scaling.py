@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+"""
+Compact (integer DN) scenes for local processing.
+
+Bands are kept as the uint16 digital numbers of the collections, with the
+scale and offset of each band next to them (the same factors as
+functions.applyScaleFactors). Reflectance and temperature are only computed
+by the consumers, chunk by chunk in float32 (bandmath.evaluate with scales,
+masks.cloudScore, sample), so a full scene takes 2 bytes per pixel and band
+instead of 4-8. DN 0 is the fill value of the collections and reads as NaN.
+"""
+
+import re
+import numpy as np
+
+## DN of masked pixels
+FILL = 0
+
+## (band pattern, scale, offset) per sensor, as in functions.applyScaleFactors
+SCALE_FACTORS = {
+    'Sentinel': [('B.*', 0.0001, 0.0)],
+    'Landsat8': [('SR_B.', 0.0000275, -0.2), ('ST_B.*', 0.00341802, 149.0)],
+    'Landsat7': [('SR_B.', 0.0000275, -0.2), ('ST_B6', 0.00341802, 149.0)],
+    }
+SCALE_FACTORS['Landsat5'] = SCALE_FACTORS['Landsat7']
+
+
+# =============================================================================
+# Function to get the scale and offset of the bands of a scene.
+
+## Usage:
+# sat = satellite name, e.g. 'Sentinel-2A', 'Landsat8'.
+# bands = list of band names.
+
+## Output:
+# dictionary band name -> (scale, offset); bands without factors are left out.
+# =============================================================================
+def scaleFactors(sat, bands):
+    from masks import sensor
+
+    scales = {}
+    for band in bands:
+        for pattern, scale, offset in SCALE_FACTORS[sensor(sat)]:
+            if re.fullmatch(pattern, band):
+                scales[band] = (scale, offset)
+                break
+    return scales
+
+###############################################################################
+
+
+# =============================================================================
+# Function to convert float bands to DN (e.g. scenes already scaled).
+
+## Usage:
+# img = dictionary band name -> float array (rows x cols), NaN where masked.
+# scales = dictionary band name -> (scale, offset), e.g. from scaleFactors.
+
+## Output:
+# dictionary band name -> uint16 array (rows x cols), FILL where masked.
+# Bands without factors are returned unchanged.
+# =============================================================================
+def toDN(img, scales):
+    dn = {}
+    for band, array in img.items():
+        if band not in scales:
+            dn[band] = array
+            continue
+        scale, offset = scales[band]
+        value = np.rint((np.asarray(array, dtype=np.float64) - offset) / scale)
+        ## Valid pixels never take the fill value
+        value = np.clip(value, FILL + 1, np.iinfo(np.uint16).max)
+        dn[band] = np.where(np.isnan(value), FILL, value).astype(np.uint16)
+    return dn
+
+###############################################################################
+
+
+# =============================================================================
+# Function to scale a window of a DN band.
+
+## Usage:
+# dn = uint16 array (any shape).
+# scale, offset = factors of the band.
+# out = optional float32 array of the same shape.
+
+## Output:
+# float32 array, dn * scale + offset, NaN where dn is FILL.
+# =============================================================================
+def scaled(dn, scale, offset, out=None):
+    out = np.multiply(dn, np.float32(scale), out=out, dtype=np.float32)
+    np.add(out, np.float32(offset), out=out)
+    np.copyto(out, np.float32(np.nan), where=(dn == FILL))
+    return out
+
+###############################################################################
+
+
+# =============================================================================
+# Function to sample bands at pixel locations (local equivalent of
+# sampleRegions on the classification bands).
+
+## Usage:
+# img = dictionary band name -> array (rows x cols), DN or float.
+# bands = list of band names (columns of the table).
+# rows, cols = int arrays of the pixel locations.
+# scales = optional dictionary band name -> (scale, offset) of the DN bands.
+
+## Output:
+# float32 array (points x bands), NaN where masked.
+# =============================================================================
+def sample(img, bands, rows, cols, scales=None):
+    scales = scales or {}
+    table = np.empty((len(rows), len(bands)), dtype=np.float32)
+    for i, band in enumerate(bands):
+        values = img[band][rows, cols]
+        if band in scales:
+            scaled(values, *scales[band], out=table[:, i])
+        else:
+            table[:, i] = values
+    return table
+
+###############################################################################
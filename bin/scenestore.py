@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+"""
+Local store of scenes, one memory-mapped array per band.
+
+Each scene is a folder named by its image ID with a .npy file per band and a
+meta.json sidecar (satellite, tile, date, transform, crs, scales...). Stages
+open only the bands they use, as read-only memmaps, so runs with different
+flags reuse the data without reading or decoding the other bands. The last
+use of a scene is the modification time of its sidecar; when the store goes
+over maxBytes the least recently used scenes are removed.
+"""
+
+import os
+import json
+import shutil
+import numpy as np
+from common import atomicWrite
+
+
+class SceneStore:
+    """
+    Scene store in the folder root.
+
+    ## Usage:
+    # root = folder of the store (created if needed).
+    # maxBytes = size bound of the band files.
+    """
+
+    def __init__(self, root, maxBytes=50 << 30):
+        self.root = root
+        self.maxBytes = maxBytes
+        os.makedirs(root, exist_ok=True)
+
+    def _folder(self, imageID):
+        return os.path.join(self.root, imageID)
+
+    def _meta(self, imageID):
+        return os.path.join(self._folder(imageID), 'meta.json')
+
+    ## Image IDs in the store
+    def scenes(self):
+        return sorted(name for name in os.listdir(self.root) if os.path.exists(self._meta(name)))
+
+    ## Metadata of a scene (None if not in the store)
+    def metadata(self, imageID):
+        if not os.path.exists(self._meta(imageID)):
+            return None
+        with open(self._meta(imageID)) as f:
+            return json.load(f)
+
+    ## Bands of a scene in the store
+    def bands(self, imageID):
+        meta = self.metadata(imageID)
+        return list(meta['bands']) if meta else []
+
+    # =========================================================================
+    # Function to add a scene, or bands of a scene already in the store.
+
+    ## Usage:
+    # imageID = image ID.
+    # img = dictionary band name -> array (rows x cols), e.g. uint16 DN.
+    # metadata = dictionary of the scene, e.g. {'satellite': 'Sentinel-2A',
+    #            'tile': '17RLL', 'date': '2019-02-08', 'transform': [...],
+    #            'crs': 'EPSG:32617', 'scales': {...}}. It updates the
+    #            metadata already in the store.
+    # =========================================================================
+    def put(self, imageID, img, metadata=None):
+        folder = self._folder(imageID)
+        os.makedirs(folder, exist_ok=True)
+        meta = self.metadata(imageID) or {'bands': {}}
+        meta.update({key: value for key, value in (metadata or {}).items() if key != 'bands'})
+        for band, array in img.items():
+            array = np.asarray(array)
+            ## Readers never map a partial band
+            atomicWrite(os.path.join(folder, band+'.npy'), lambda tmp: np.save(tmp, array))
+            meta['bands'][band] = {'dtype': array.dtype.str, 'shape': list(array.shape)}
+        def writeMeta(tmp):
+            with open(tmp, 'w') as f:
+                json.dump(meta, f)
+        atomicWrite(self._meta(imageID), writeMeta)
+        self.evict(keep=imageID)
+
+    # =========================================================================
+    # Function to open bands of a scene.
+
+    ## Usage:
+    # imageID = image ID.
+    # bands = list of band names (default: all the bands in the store).
+
+    ## Output:
+    # img = dictionary band name -> read-only np.memmap (rows x cols).
+    # metadata = dictionary of the scene.
+    # Raises KeyError if the scene or a band is not in the store.
+    # =========================================================================
+    def open(self, imageID, bands=None):
+        meta = self.metadata(imageID)
+        if meta is None:
+            raise KeyError(imageID)
+        bands = list(meta['bands']) if bands is None else list(bands)
+        missing = [band for band in bands if band not in meta['bands']]
+        if missing:
+            raise KeyError(imageID+': '+', '.join(missing))
+        img = {band: np.load(os.path.join(self._folder(imageID), band+'.npy'), mmap_mode='r')
+               for band in bands}
+        ## Mark as recently used
+        os.utime(self._meta(imageID))
+        return img, meta
+
+    # =========================================================================
+    # Function to open bands of a scene, loading the missing ones.
+
+    ## Usage:
+    # imageID = image ID.
+    # bands = list of band names.
+    # load = function(imageID, bands) -> (img, metadata) reading only the
+    #        given bands from the source (e.g. a GeoTIFF or an EE download).
+
+    ## Output:
+    # img, metadata as in open.
+    # =========================================================================
+    def fetch(self, imageID, bands, load):
+        missing = [band for band in bands if band not in self.bands(imageID)]
+        if missing:
+            img, metadata = load(imageID, missing)
+            self.put(imageID, {band: img[band] for band in missing}, metadata)
+        return self.open(imageID, bands)
+
+    ## Remove a scene from the store
+    def remove(self, imageID):
+        shutil.rmtree(self._folder(imageID), ignore_errors=True)
+
+    ## Bytes of the band files of each scene
+    def sizes(self):
+        sizes = {}
+        for imageID in self.scenes():
+            folder = self._folder(imageID)
+            sizes[imageID] = sum(os.path.getsize(os.path.join(folder, name))
+                                 for name in os.listdir(folder) if name.endswith('.npy'))
+        return sizes
+
+    ## Remove the least recently used scenes until the store fits in maxBytes
+    def evict(self, keep=None):
+        sizes = self.sizes()
+        total = sum(sizes.values())
+        used = sorted(sizes, key=lambda imageID: os.path.getmtime(self._meta(imageID)))
+        removed = []
+        for imageID in used:
+            if total <= self.maxBytes:
+                break
+            if imageID == keep:
+                continue
+            self.remove(imageID)
+            total -= sizes[imageID]
+            removed.append(imageID)
+        return removed
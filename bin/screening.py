@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+"""
+Pre-screening of the images before the full processing.
+
+Scenes that are almost fully cloudy, have too few ground points inside
+aoi & image footprint, or too few sand polygons for a stable DII are left
+out before any masking, sampling, training or export is done. The checks
+of all scenes are mapped over one collection and fetched in one request:
+the clear fraction comes from CloudScore6S on a coarse overview, and the
+points and polygons are counted with spatial filters.
+"""
+
+## Default minimums. 'clear' is the fraction of the region without clouds.
+MINIMUMS = {'clear': 0.2, 'points': 20, 'sand': 1}
+
+## Scale (m) of the coarse overview used for the clear fraction.
+OVERVIEW_SCALE = 300
+
+
+# =============================================================================
+# Function to screen an imageList.
+
+## Usage:
+# imageIDs = list of image IDs.
+# imageSource, satellite, boaFolder = as in start_processing.
+# aoi = featureCollection of the region of interest.
+# sand_areas = featureCollection of sand polygons for DII.
+# groundPoints = featureCollection of ground-truth points.
+# minimums = dictionary with the minimum 'clear' fraction, number of 'points'
+#            and number of 'sand' polygons (default: MINIMUMS). Use None for
+#            a value to skip that check (e.g. 'sand': None when dii is 0).
+# defer = if True, failed scenes are returned as deferred instead of rejected
+#         (e.g. to try them again later with lower minimums).
+
+## Output:
+# accepted = list of image IDs to process.
+# skipped = dictionary image ID -> (status, reason), status 'rejected' or 'deferred'.
+# checks = dictionary image ID -> dictionary with 'clear', 'points' and 'sand'.
+# =============================================================================
+def screenScenes(imageIDs, imageSource, satellite, boaFolder, aoi, sand_areas, groundPoints,
+                 minimums=None, defer=False):
+    import ee
+    from functions import applyScaleFactors,CloudScore6S
+    from planner import collectionPath
+
+    limits = dict(MINIMUMS)
+    limits.update(minimums or {})
+    imageIDs = list(dict.fromkeys(imageIDs))
+    collection = ee.ImageCollection(collectionPath(imageSource, satellite, boaFolder).rstrip('/'))\
+                   .filter(ee.Filter.inList('system:index', imageIDs))
+    region = aoi.geometry()
+
+    def check(image):
+        image = ee.Image(image)
+        imageGeometry = image.geometry()
+        ## Fraction of clear pixels of the region, on a coarse overview
+        cloudMask = CloudScore6S(satellite, applyScaleFactors(image, imageSource, satellite), 5)\
+                      .select('cloudMask').unmask(0)
+        clear = cloudMask.reduceRegion(**{
+            'reducer': ee.Reducer.mean(),
+            'geometry': imageGeometry.intersection(region, 100),
+            'scale': OVERVIEW_SCALE,
+            'bestEffort': True,
+            'maxPixels': 1e8}).get('cloudMask')
+        points = ee.FeatureCollection(groundPoints).filterBounds(aoi).filterBounds(imageGeometry).size()
+        sand = ee.FeatureCollection(sand_areas).filterBounds(imageGeometry).size()
+        return ee.Feature(None, {'image_id': image.get('system:index'),
+                                 'clear': clear, 'points': points, 'sand': sand})
+
+    features = ee.FeatureCollection(collection.map(check)).getInfo()['features']
+    checks = {f['properties']['image_id']: f['properties'] for f in features}
+
+    status = 'deferred' if defer else 'rejected'
+    accepted, skipped = [], {}
+    for imageID in imageIDs:
+        if imageID not in checks:
+            skipped[imageID] = (status, 'not found in '+collectionPath(imageSource, satellite, boaFolder))
+            continue
+        values = checks[imageID]
+        reasons = [key+' '+str(values.get(key))+' < '+str(limits[key])
+                   for key in ('clear', 'points', 'sand')
+                   if limits.get(key) is not None and (values.get(key) or 0) < limits[key]]
+        if reasons:
+            skipped[imageID] = (status, ', '.join(reasons))
+        else:
+            accepted.append(imageID)
+
+    for imageID, (state, reason) in skipped.items():
+        print('   Screening: '+imageID+' '+state+' ('+reason+')')
+    print('   Screening: '+str(len(accepted))+' of '+str(len(imageIDs))+' images accepted')
+    return accepted, skipped, checks
+
+###############################################################################
+
+
+# =============================================================================
+# Function to estimate the clear fraction of a local scene on an overview.
+
+## Usage:
+# sat = satellite name.
+# img = dictionary band name -> array (rows x cols), as in masks.cloudScore.
+# step = decimation of the overview (30 -> 300 m for Sentinel-2).
+# cloudThresh = threshold of the cloud score.
+# scales = optional dictionary band name -> (scale, offset) if img is in DN.
+
+## Output:
+# fraction of the unmasked overview pixels that are clear (None if all masked).
+# =============================================================================
+def clearFraction(sat, img, step=30, cloudThresh=5, scales=None):
+    from masks import cloudScore
+
+    overview = {band: array[::step, ::step] for band, array in img.items()}
+    score, cloudMask = cloudScore(sat, overview, cloudThresh, scales=scales)
+    valid = score != 255
+    if not valid.any():
+        return None
+    return float(cloudMask[valid].mean())
+
+###############################################################################
@@ -0,0 +1,294 @@
+# -*- coding: utf-8 -*-
+"""
+Tile-parallel local classification of one scene.
+
+The band stack is copied once to multiprocessing.shared_memory and the class
+map is written to a shared uint8 array. Pool workers attach to both when they
+start (with the classifier and the global statistics, e.g. the DII
+coefficients from the sand pixels) and then only receive tile coordinates:
+each one runs mask -> DII -> smooth -> classify on zero-copy views of its
+tile, padded with a halo for the smoothing kernel, and writes the class codes
+of the tile without the halo. No arrays are pickled. The spectral indices
+of the masks (NDSI of the cloud score, NDWI of the tidal mask) are computed
+once for the whole scene through an indexcache.IndexCache and shared the
+same way, so runs with other flags reuse them. With a writer, the
+finished tiles are handed to writer.ChunkWriter as they complete, so the
+chunks are compressed and saved while the other tiles are classified.
+"""
+
+import os
+import numpy as np
+from multiprocessing import shared_memory
+from concurrent.futures import ProcessPoolExecutor,as_completed
+from common import NODATA
+
+## ee.Kernel.euclidean(radius=1, units='pixels', normalize=True)
+_SMOOTH = np.array([[2 ** 0.5, 1, 2 ** 0.5], [1, 0, 1], [2 ** 0.5, 1, 2 ** 0.5]], dtype=np.float32)
+_SMOOTH /= _SMOOTH.sum()
+
+## State of a worker, set by _attach
+_state = {}
+
+
+# =============================================================================
+# Function to get the DII coefficients of band pairs (global statistics,
+# as in functions.DII).
+
+## Usage:
+# img = dictionary band name -> array (rows x cols).
+# pairs = dictionary DII band name -> (band i, band j), e.g. {'B2B3': ('B2', 'B3')}.
+# sand = bool array (rows x cols), True on the sand pixels (e.g. rasterize.cachedMask).
+# scales = optional dictionary band name -> (scale, offset) if img is in DN.
+
+## Output:
+# dictionary DII band name -> (band i, band j, k), with
+# DII = ln(Li) - k ln(Lj).
+# =============================================================================
+def diiCoefficients(img, pairs, sand, scales=None):
+    from scaling import scaled
+
+    scales = scales or {}
+    coefficients = {}
+    for name, (i, j) in pairs.items():
+        values = []
+        for band in (i, j):
+            v = img[band][sand]
+            values.append(scaled(v, *scales[band]) if band in scales else v.astype(np.float32))
+        valid = ~(np.isnan(values[0]) | np.isnan(values[1]))
+        cov = np.cov(values[0][valid], values[1][valid])
+        ## Attenuation coefficient and ratio of attenuation coefficients
+        a = (cov[0, 0] - cov[1, 1]) / (2 * cov[0, 1])
+        coefficients[name] = (i, j, float(a + np.sqrt(a * a + 1)))
+    return coefficients
+
+###############################################################################
+
+
+## Row and column ranges of the tiles, (core, padded with the halo).
+def _tiles(shape, tile, halo):
+    rows, cols = shape
+    for r0 in range(0, rows, tile):
+        for c0 in range(0, cols, tile):
+            r1, c1 = min(r0 + tile, rows), min(c0 + tile, cols)
+            yield (r0, r1, c0, c1), (max(r0 - halo, 0), min(r1 + halo, rows),
+                                     max(c0 - halo, 0), min(c1 + halo, cols))
+
+
+def _attach(stackName, stackShape, stackDtype, outName, landName, indexName, pairs, bands, config):
+    stackMemory = shared_memory.SharedMemory(name=stackName)
+    outMemory = shared_memory.SharedMemory(name=outName)
+    _state['memory'] = [stackMemory, outMemory]
+    _state['stack'] = np.ndarray(stackShape, dtype=stackDtype, buffer=stackMemory.buf)
+    _state['out'] = np.ndarray(stackShape[1:], dtype=np.uint8, buffer=outMemory.buf)
+    _state['land'] = None
+    if landName is not None:
+        landMemory = shared_memory.SharedMemory(name=landName)
+        _state['memory'].append(landMemory)
+        _state['land'] = np.ndarray(stackShape[1:], dtype=bool, buffer=landMemory.buf)
+    _state['indices'] = {}
+    if indexName is not None:
+        indexMemory = shared_memory.SharedMemory(name=indexName)
+        _state['memory'].append(indexMemory)
+        indices = np.ndarray((len(pairs),) + tuple(stackShape[1:]), dtype=np.float32, buffer=indexMemory.buf)
+        _state['indices'] = {pair: indices[i] for i, pair in enumerate(pairs)}
+    _state['bands'] = bands
+    _state['config'] = config
+
+
+class _TileIndices:
+    """Windows of the scene indices in shared memory, read by the masks as an IndexCache."""
+
+    def __init__(self, padded):
+        self.padded = padded
+
+    def index(self, scene, img, pair, operation='nd', scales=None, version=None):
+        pr0, pr1, pc0, pc1 = self.padded
+        return _state['indices'][tuple(pair)][pr0:pr1, pc0:pc1]
+
+
+def _detach():
+    memories = _state.pop('memory', [])
+    _state.clear()
+    for memory in memories:
+        memory.close()
+
+
+## Smooth the features (rows x cols x n) with the euclidean kernel. Pixels
+## next to a masked one are masked, as in convolve.
+def _smooth(features):
+    rows, cols = features.shape[:2]
+    out = np.zeros((rows - 2, cols - 2, features.shape[2]), dtype=np.float32)
+    for dr in range(3):
+        for dc in range(3):
+            out += _SMOOTH[dr, dc] * features[dr:dr + rows - 2, dc:dc + cols - 2]
+    return out
+
+
+def _classifyTile(core, padded):
+    from masks import sensor, cloudScore, tidalMask, shallowTurbidityMask, TIDAL_BANDS
+    from scaling import scaled
+
+    config = _state['config']
+    scales = config['scales'] or {}
+    pr0, pr1, pc0, pc1 = padded
+    ## Zero-copy views of the padded tile
+    img = {band: _state['stack'][i, pr0:pr1, pc0:pc1] for i, band in enumerate(_state['bands'])}
+
+    ## Masks (indices read from the scene ones when shared)
+    indices = _TileIndices(padded) if _state['indices'] else None
+    if config['cloud']:
+        _, valid = cloudScore(config['satellite'], img, config['cloudThresh'], scales=scales, cache=indices)
+    else:
+        valid = np.ones((pr1 - pr0, pc1 - pc0), dtype=bool)
+    if _state['land'] is not None:
+        valid &= _state['land'][pr0:pr1, pc0:pc1]
+    if config['flat']:
+        nir, green = TIDAL_BANDS[sensor(config['satellite'])]
+        valid &= tidalMask(img, nir, green, scales=scales, cache=indices)
+    if config['turbid']:
+        valid &= np.unpackbits(shallowTurbidityMask(config['satellite'], img, scales=scales),
+                               axis=1, count=pc1 - pc0).view(bool)
+
+    ## Features: bands (scaled) and DII bands
+    features = np.empty((pr1 - pr0, pc1 - pc0, len(config['bandsClass'])), dtype=np.float32)
+    for f, band in enumerate(config['bandsClass']):
+        if band in config['dii']:
+            i, j, k = config['dii'][band]
+            li = scaled(img[i], *scales[i]) if i in scales else img[i].astype(np.float32)
+            lj = scaled(img[j], *scales[j]) if j in scales else img[j].astype(np.float32)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                features[..., f] = np.log(li) - k * np.log(lj)
+        elif band in scales:
+            scaled(img[band], *scales[band], out=features[..., f])
+        else:
+            features[..., f] = img[band]
+    features[~valid] = np.nan
+
+    ## Smoothing (tiles at the border of the scene are padded as masked),
+    ## then drop the halo
+    r0, r1, c0, c1 = core
+    if config['smooth']:
+        pad = ((1 - (r0 - pr0), 1 - (pr1 - r1)), (1 - (c0 - pc0), 1 - (pc1 - c1)), (0, 0))
+        features = _smooth(np.pad(features, pad, constant_values=np.nan))
+    else:
+        features = features[r0 - pr0:r1 - pr0, c0 - pc0:c1 - pc0]
+
+    ## Classify the valid pixels
+    table = features.reshape(-1, features.shape[2])
+    keep = ~np.isnan(table).any(axis=1)
+    classes = np.full(len(table), NODATA, dtype=np.uint8)
+    if keep.any():
+        classes[keep] = config['model'].predict(table[keep])
+    _state['out'][r0:r1, c0:c1] = classes.reshape(r1 - r0, c1 - c0)
+    return core
+
+
+# =============================================================================
+# Function to classify a scene by tiles on a process pool.
+
+## Usage:
+# sat = satellite name.
+# img = dictionary band name -> array (rows x cols), reflectance or DN.
+# model = fitted classifier with predict() (e.g. the SVC of validation.py).
+# bandsClass = features of the model, e.g. ['B1','B2','B3','B4','B2B3'].
+# dii = dictionary from diiCoefficients (for the DII bands in bandsClass).
+# landMask = optional bool array (rows x cols), True on water.
+# smooth = if True, features are smoothed as with smoothStr '_smooth_'.
+# cloud = if True, applies the cloud mask (masks.cloudScore).
+# flat = if True, applies the tidal flat mask (masks.tidalMask).
+# turbid = if True, applies masks.shallowTurbidityMask.
+# cloudThresh = threshold of the cloud score.
+# scales = optional dictionary band name -> (scale, offset) if img is in DN.
+# tile = size (pixels) of the tiles.
+# workers = number of processes (default: all cores; 1 runs in this process).
+# writer = optional writer.ChunkWriter of the scene shape; each tile is written
+#          to it as soon as it is classified (tile a multiple of its chunks
+#          keeps the chunks of a tile together).
+# cache = optional indexcache.IndexCache; the indices of the cloud and tidal
+#         masks are computed once for the scene through it (default: a cache
+#         for this call only).
+# scene, version = key of the scene and token of its band data in the cache
+#                  (see IndexCache.index).
+
+## Output:
+# uint8 array (rows x cols), class codes, NODATA where masked. None with a
+# writer (the map is in the writer; close it to finish the last chunks).
+# =============================================================================
+def classifyScene(sat, img, model, bandsClass, dii=None, landMask=None, smooth=False, cloud=True,
+                  flat=False, turbid=False, cloudThresh=5, scales=None, tile=1024, workers=None,
+                  writer=None, cache=None, scene=None, version=None):
+    from masks import sensor, CLOUD_NDSI, TIDAL_BANDS
+    from indexcache import IndexCache
+
+    bands = list(img)
+    first = np.asarray(img[bands[0]])
+    shape = (len(bands),) + first.shape
+    config = {'satellite': sat, 'model': model, 'bandsClass': list(bandsClass), 'dii': dii or {},
+              'smooth': smooth, 'cloud': cloud, 'flat': flat, 'turbid': turbid,
+              'cloudThresh': cloudThresh, 'scales': scales}
+
+    memories = []
+    try:
+        ## Band stack, output and land mask in shared memory (one copy)
+        stackMemory = shared_memory.SharedMemory(create=True, size=int(np.prod(shape)) * first.dtype.itemsize)
+        memories.append(stackMemory)
+        stack = np.ndarray(shape, dtype=first.dtype, buffer=stackMemory.buf)
+        for i, band in enumerate(bands):
+            stack[i] = img[band]
+        del stack
+        outMemory = shared_memory.SharedMemory(create=True, size=int(np.prod(shape[1:])))
+        memories.append(outMemory)
+        landName = None
+        if landMask is not None:
+            landMemory = shared_memory.SharedMemory(create=True, size=int(np.prod(shape[1:])))
+            memories.append(landMemory)
+            np.ndarray(shape[1:], dtype=bool, buffer=landMemory.buf)[...] = landMask
+            landName = landMemory.name
+
+        ## Scene indices of the masks, computed through the cache
+        pairs = [CLOUD_NDSI[sensor(sat)]] if cloud else []
+        if flat and TIDAL_BANDS[sensor(sat)] not in pairs:
+            pairs.append(TIDAL_BANDS[sensor(sat)])
+        indexName = None
+        if pairs:
+            cache = cache if cache is not None else IndexCache()
+            indexMemory = shared_memory.SharedMemory(create=True, size=len(pairs) * int(np.prod(shape[1:])) * 4)
+            memories.append(indexMemory)
+            indices = np.ndarray((len(pairs),) + shape[1:], dtype=np.float32, buffer=indexMemory.buf)
+            for i, pair in enumerate(pairs):
+                indices[i] = cache.index(scene, img, pair, 'nd', scales, version)
+            del indices
+            indexName = indexMemory.name
+
+        initargs = (stackMemory.name, shape, first.dtype.str, outMemory.name, landName, indexName, pairs,
+                    bands, config)
+        tiles = list(_tiles(shape[1:], tile, 1 if smooth else 0))
+        out = np.ndarray(shape[1:], dtype=np.uint8, buffer=outMemory.buf)
+        workers = workers or os.cpu_count()
+        try:
+            if workers == 1:
+                _attach(*initargs)
+                try:
+                    for core, padded in tiles:
+                        _classifyTile(core, padded)
+                        if writer is not None:
+                            writer.write(core[0], core[2], out[core[0]:core[1], core[2]:core[3]])
+                finally:
+                    _detach()
+            else:
+                with ProcessPoolExecutor(workers, initializer=_attach, initargs=initargs) as pool:
+                    jobs = [pool.submit(_classifyTile, core, padded) for core, padded in tiles]
+                    ## Tiles in order of completion
+                    for job in as_completed(jobs):
+                        r0, r1, c0, c1 = job.result()
+                        if writer is not None:
+                            writer.write(r0, c0, out[r0:r1, c0:c1])
+            return None if writer is not None else out.copy()
+        finally:
+            del out
+    finally:
+        for memory in memories:
+            memory.close()
+            memory.unlink()
+
+###############################################################################
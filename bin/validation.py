@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+"""
+K-fold cross-validation of the SVM classifier.
+
+The sampled feature table (output of sampleRegions) is fetched once and the
+folds are trained concurrently on a local process pool, so k folds cost
+about the wall time of a single fold on a k-core machine.
+"""
+
+import os
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from metrics import confusionMatrix,accuracies
+
+
+# =============================================================================
+# Function to fetch the sampled feature table from Earth Engine.
+
+## Usage:
+# samplingData = featureCollection returned by sampleRegions.
+# bandsClass = list of band names used as input properties, e.g. ['B1','B2','B3','B4','B2B3']
+# classProperty = str property holding the ground-truth class.
+
+## Output:
+# features = float32 array (points x bands)
+# labels = int array (points)
+# =============================================================================
+def featureTable(samplingData, bandsClass, classProperty='class'):
+    import ee
+
+    columns = list(bandsClass) + [classProperty]
+    ## One request for the whole table instead of one per column.
+    table = samplingData.reduceColumns(**{
+        'reducer': ee.Reducer.toList(len(columns)),
+        'selectors': columns}).get('list').getInfo()
+
+    table = np.asarray(table, dtype=np.float64).reshape(-1, len(columns))
+    features = table[:, :-1].astype(np.float32)
+    labels = table[:, -1].astype(int)
+    return features, labels
+
+###############################################################################
+
+
+# =============================================================================
+# Function to turn a local feature table back into a featureCollection
+# (e.g. to train ee.Classifier.libsvm on cached samples without sampling).
+
+## Usage:
+# features = array (points x bands), e.g. from samplecache.cachedSamples.
+# labels = int array (points).
+# bandsClass = list of band names of the columns of features.
+# classProperty = str property holding the ground-truth class.
+
+## Output:
+# featureCollection with one feature (no geometry) per point.
+# =============================================================================
+def tableCollection(features, labels, bandsClass, classProperty='class'):
+    import ee
+
+    rows = np.asarray(features, dtype=np.float64).tolist()
+    return ee.FeatureCollection([
+        ee.Feature(None, dict(zip(bandsClass, row), **{classProperty: int(label)}))
+        for row, label in zip(rows, np.asarray(labels).tolist())])
+
+###############################################################################
+
+
+# =============================================================================
+# Function to assign every point to one of k folds.
+
+## Usage:
+# labels = int array of classes.
+# k = number of folds.
+# stratified = if True, each class is spread evenly across the folds.
+# seed = random seed of the assignment (local; it does not reproduce
+#        randomColumn in process.py).
+# =============================================================================
+def kFoldIndex(labels, k=5, stratified=True, seed=0):
+    labels = np.asarray(labels)
+    rng = np.random.default_rng(seed)
+    folds = np.empty(labels.size, dtype=int)
+
+    if stratified:
+        ## Continue the fold counter between classes so small classes
+        ## do not all land in the first fold.
+        start = 0
+        for c in np.unique(labels):
+            idx = np.flatnonzero(labels == c)
+            folds[rng.permutation(idx)] = (np.arange(idx.size) + start) % k
+            start += idx.size
+    else:
+        folds[rng.permutation(labels.size)] = np.arange(labels.size) % k
+
+    return folds
+
+###############################################################################
+
+
+## Train on all folds but one and return the confusion matrix of the held-out fold.
+## Top level so it can be sent to the process pool.
+def _trainFold(args):
+    from sklearn.svm import SVC
+
+    features, labels, folds, fold, gamma, cost, nClasses = args
+    train = folds != fold
+
+    ## Same RBF libsvm setup as ee.Classifier.libsvm in process.py
+    SVM = SVC(kernel='rbf', gamma=gamma, C=cost)
+    SVM.fit(features[train], labels[train])
+    predicted = SVM.predict(features[~train])
+
+    return confusionMatrix(labels[~train], predicted, nClasses)
+
+
+# =============================================================================
+# K-fold cross-validation
+
+## Usage:
+# features = array (points x bands), e.g. from featureTable.
+# labels = int array of classes (0: Sb, 1: Hb, 2: Dn, 3: Sp).
+# k = number of folds.
+# stratified = if True, folds keep the class proportions.
+# gamma, cost = SVM parameters.
+# workers = number of processes (default: one per fold, up to the cpu count).
+
+## Output:
+# dictionary with the per-fold confusion matrices ('matrices'), the pooled
+# out-of-fold matrix ('matrix') and the mean/std of 'accuracy', 'producer',
+# 'user' and 'kappa' across folds (e.g. cv['kappa'] = (mean, std)).
+# =============================================================================
+def crossValidate(features, labels, k=5, stratified=True, gamma=100, cost=100,
+                  nClasses=4, seed=0, workers=None):
+    features = np.asarray(features, dtype=np.float32)
+    labels = np.asarray(labels, dtype=int)
+    folds = kFoldIndex(labels, k, stratified, seed)
+
+    if workers is None:
+        workers = min(k, os.cpu_count() or 1)
+
+    jobs = [(features, labels, folds, fold, gamma, cost, nClasses) for fold in range(k)]
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            matrices = np.stack(list(pool.map(_trainFold, jobs)))
+    else:
+        matrices = np.stack([_trainFold(job) for job in jobs])
+
+    ## All folds scored in one vectorized batch
+    scores = accuracies(matrices)
+
+    cv = {'folds': k, 'matrices': matrices, 'matrix': matrices.sum(axis=0)}
+    for key in ['accuracy', 'producer', 'user', 'kappa']:
+        cv[key] = (scores[key].mean(axis=0), scores[key].std(axis=0))
+    return cv
+
+###############################################################################
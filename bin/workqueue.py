@@ -0,0 +1,287 @@
+# -*- coding: utf-8 -*-
+"""
+Durable work queue of images to process, on a SQLite file.
+
+A producer enqueues (imageID, satellite, regionName, flags) jobs and any
+number of workers, on this or other machines sharing the file, lease them,
+send heartbeats while they work, and complete or fail them. Leases that are
+not renewed (crashed workers) expire and the job goes back to the queue, up
+to maxAttempts. Every call opens its own connection and changes state in one
+IMMEDIATE transaction, so the file is the only shared state.
+"""
+
+import os
+import json
+import time
+import socket
+import sqlite3
+import threading
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY,
+    image_id TEXT NOT NULL,
+    satellite TEXT NOT NULL,
+    region TEXT NOT NULL,
+    flags TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    max_attempts INTEGER NOT NULL,
+    worker TEXT,
+    lease_until REAL,
+    enqueued REAL NOT NULL,
+    started REAL,
+    finished REAL,
+    error TEXT,
+    UNIQUE (image_id, satellite, region, flags));
+CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, lease_until);
+"""
+
+_COLUMNS = ('id', 'image_id', 'satellite', 'region', 'flags', 'status', 'attempts',
+            'max_attempts', 'worker', 'lease_until', 'enqueued', 'started', 'finished', 'error')
+
+
+## Default name of a worker: host and process id
+def workerName():
+    return socket.gethostname()+':'+str(os.getpid())
+
+
+def _job(row):
+    job = dict(zip(_COLUMNS, row))
+    job['flags'] = json.loads(job['flags'])
+    return job
+
+
+class WorkQueue:
+    """
+    Work queue on the SQLite file path.
+
+    ## Usage:
+    # path = SQLite file (created if needed), local or on a shared filesystem.
+    # lease = seconds a leased job stays with its worker without a heartbeat.
+    # maxAttempts = leases of a job before it is marked as failed.
+    """
+
+    def __init__(self, path, lease=600, maxAttempts=3):
+        self.path = path
+        self.leaseSeconds = lease
+        self.maxAttempts = maxAttempts
+        db = sqlite3.connect(self.path, timeout=60)
+        try:
+            db.executescript(_SCHEMA)
+        finally:
+            db.close()
+
+    def _connect(self):
+        ## Isolation handled by hand: BEGIN IMMEDIATE takes the write lock
+        ## before reading, so two workers never lease the same job.
+        return _Transaction(sqlite3.connect(self.path, timeout=60, isolation_level=None))
+
+    # =========================================================================
+    # Function to add jobs.
+
+    ## Usage:
+    # jobs = list of (imageID, satellite, regionName, flags) with flags a
+    #        dictionary of the other arguments, e.g. {'cloud': 1, 'dii': 1}.
+
+    ## Output:
+    # number of jobs added (jobs already in the queue are left as they are).
+    # =========================================================================
+    def enqueue(self, jobs):
+        now = time.time()
+        rows = [(imageID, satellite, regionName, json.dumps(flags or {}, sort_keys=True),
+                 self.maxAttempts, now) for imageID, satellite, regionName, flags in jobs]
+        with self._connect() as db:
+            before = db.total_changes
+            db.executemany('INSERT OR IGNORE INTO jobs (image_id, satellite, region, flags, '
+                           'max_attempts, enqueued) VALUES (?, ?, ?, ?, ?, ?)', rows)
+            return db.total_changes - before
+
+    ## Expired leases go back to the queue, or fail after max_attempts.
+    def _reclaim(self, db, now):
+        db.execute("UPDATE jobs SET status = 'failed', finished = ?, error = 'lease expired' "
+                   "WHERE status = 'leased' AND lease_until < ? AND attempts >= max_attempts", (now, now))
+        db.execute("UPDATE jobs SET status = 'pending', worker = NULL, lease_until = NULL "
+                   "WHERE status = 'leased' AND lease_until < ?", (now,))
+
+    # =========================================================================
+    # Function to lease jobs.
+
+    ## Usage:
+    # worker = name of the worker (default: host:pid).
+    # n = number of jobs.
+    # satellite, region = optional filters, e.g. for a worker of one collection.
+
+    ## Output:
+    # list of job dictionaries (empty when there is nothing to do).
+    # =========================================================================
+    def lease(self, worker=None, n=1, satellite=None, region=None):
+        worker = worker or workerName()
+        now = time.time()
+        query = "SELECT id FROM jobs WHERE status = 'pending'"
+        args = []
+        if satellite is not None:
+            query += ' AND satellite = ?'
+            args.append(satellite)
+        if region is not None:
+            query += ' AND region = ?'
+            args.append(region)
+        query += ' ORDER BY attempts, id LIMIT ?'
+        args.append(n)
+
+        with self._connect() as db:
+            self._reclaim(db, now)
+            ids = [row[0] for row in db.execute(query, args)]
+            db.executemany("UPDATE jobs SET status = 'leased', worker = ?, lease_until = ?, "
+                           "started = ?, attempts = attempts + 1 WHERE id = ?",
+                           [(worker, now + self.leaseSeconds, now, i) for i in ids])
+            return [_job(row) for i in ids
+                    for row in db.execute('SELECT '+', '.join(_COLUMNS)+' FROM jobs WHERE id = ?', (i,))]
+
+    ## Extend the lease of a job. False if the worker lost it (expired and reclaimed).
+    def heartbeat(self, jobId, worker=None):
+        with self._connect() as db:
+            cursor = db.execute("UPDATE jobs SET lease_until = ? WHERE id = ? AND worker = ? AND status = 'leased'",
+                                (time.time() + self.leaseSeconds, jobId, worker or workerName()))
+            return cursor.rowcount == 1
+
+    ## Mark a leased job as done. False if the worker lost it.
+    def complete(self, jobId, worker=None):
+        with self._connect() as db:
+            cursor = db.execute("UPDATE jobs SET status = 'done', finished = ?, lease_until = NULL, error = NULL "
+                                "WHERE id = ? AND worker = ? AND status = 'leased'",
+                                (time.time(), jobId, worker or workerName()))
+            return cursor.rowcount == 1
+
+    ## Give a leased job back after an error: it is retried until max_attempts.
+    def fail(self, jobId, error, worker=None):
+        with self._connect() as db:
+            cursor = db.execute("UPDATE jobs SET status = CASE WHEN attempts >= max_attempts "
+                                "THEN 'failed' ELSE 'pending' END, finished = ?, lease_until = NULL, "
+                                "worker = NULL, error = ? WHERE id = ? AND worker = ? AND status = 'leased'",
+                                (time.time(), str(error), jobId, worker or workerName()))
+            return cursor.rowcount == 1
+
+    ## Put failed jobs back in the queue with new attempts (e.g. after a fix).
+    def retryFailed(self):
+        with self._connect() as db:
+            cursor = db.execute("UPDATE jobs SET status = 'pending', attempts = 0, worker = NULL, "
+                                "finished = NULL WHERE status = 'failed'")
+            return cursor.rowcount
+
+    # =========================================================================
+    # Function to get the progress of the queue.
+
+    ## Usage:
+    # window = seconds over which the throughput is measured.
+
+    ## Output:
+    # dictionary with the number of jobs by status ('pending', 'leased',
+    # 'done', 'failed', 'total'), 'workers' (with a live lease), 'throughput'
+    # (jobs done per hour in the window), 'mean_seconds' (per done job) and
+    # 'eta_hours' (remaining jobs at the current throughput, None if idle).
+    # =========================================================================
+    def stats(self, window=3600):
+        now = time.time()
+        with self._connect() as db:
+            self._reclaim(db, now)
+            counts = dict(db.execute('SELECT status, COUNT(*) FROM jobs GROUP BY status').fetchall())
+            workers = db.execute("SELECT COUNT(DISTINCT worker) FROM jobs WHERE status = 'leased'").fetchone()[0]
+            recent = db.execute("SELECT COUNT(*) FROM jobs WHERE status = 'done' AND finished >= ?",
+                                (now - window,)).fetchone()[0]
+            mean = db.execute("SELECT AVG(finished - started) FROM jobs WHERE status = 'done'").fetchone()[0]
+
+        stats = {status: counts.get(status, 0) for status in ('pending', 'leased', 'done', 'failed')}
+        stats['total'] = sum(counts.values())
+        stats['workers'] = workers
+        stats['throughput'] = recent * 3600.0 / window
+        stats['mean_seconds'] = mean
+        remaining = stats['pending'] + stats['leased']
+        stats['eta_hours'] = remaining / stats['throughput'] if stats['throughput'] else None
+        return stats
+
+    ## Jobs with a given status (e.g. 'failed', to read their errors)
+    def jobs(self, status=None):
+        query = 'SELECT '+', '.join(_COLUMNS)+' FROM jobs'
+        with self._connect() as db:
+            if status is None:
+                return [_job(row) for row in db.execute(query+' ORDER BY id')]
+            return [_job(row) for row in db.execute(query+' WHERE status = ? ORDER BY id', (status,))]
+
+
+class _Transaction:
+    """Connection used as 'with': BEGIN IMMEDIATE, then COMMIT or ROLLBACK and close."""
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    def __enter__(self):
+        self.connection.execute('BEGIN IMMEDIATE')
+        return self.connection
+
+    def __exit__(self, kind, value, traceback):
+        try:
+            self.connection.execute('ROLLBACK' if kind else 'COMMIT')
+        finally:
+            self.connection.close()
+        return False
+
+
+# =============================================================================
+# Function to run a worker until the queue is empty.
+
+## Usage:
+# queue = WorkQueue.
+# handler = function(job) doing the work, e.g. calling start_processing with
+#           imageList=[job['image_id']], job['satellite'], job['region'] and
+#           the arguments in job['flags']. Exceptions fail the job. If a
+#           heartbeat finds the lease lost (expired and reclaimed, so another
+#           worker may run the job), job['lost'] (threading.Event) is set:
+#           long handlers should check it between steps (e.g. before each
+#           export) and stop.
+# worker = name of the worker (default: host:pid).
+# satellite, region = optional filters, as in WorkQueue.lease.
+# wait = seconds to wait for new jobs when the queue is empty (0: stop).
+
+## Output:
+# number of jobs completed by this worker.
+# =============================================================================
+def work(queue, handler, worker=None, satellite=None, region=None, wait=0):
+    worker = worker or workerName()
+    completed = 0
+    while True:
+        jobs = queue.lease(worker, 1, satellite, region)
+        if not jobs:
+            if wait <= 0:
+                return completed
+            time.sleep(wait)
+            continue
+        job = jobs[0]
+
+        ## Heartbeats from a thread, so a long export keeps its lease. A failed
+        ## heartbeat means the job is no longer ours: flag it to the handler.
+        done = threading.Event()
+        job['lost'] = threading.Event()
+        def beat():
+            while not done.wait(queue.leaseSeconds / 3.0):
+                if not queue.heartbeat(job['id'], worker):
+                    print('   Job '+str(job['id'])+' ('+job['image_id']+') lost its lease')
+                    job['lost'].set()
+                    return
+        thread = threading.Thread(target=beat, daemon=True)
+        thread.start()
+        try:
+            handler(job)
+        except Exception as error:
+            print('   Job '+str(job['id'])+' ('+job['image_id']+') failed: '+repr(error))
+            queue.fail(job['id'], repr(error), worker)
+        else:
+            if job['lost'].is_set():
+                print('   Job '+str(job['id'])+' ('+job['image_id']+') not completed: lease lost')
+            elif queue.complete(job['id'], worker):
+                completed += 1
+        finally:
+            done.set()
+            thread.join()
+
+###############################################################################
@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+"""
+Chunked, compressed writer for classified maps.
+
+Class maps are written as Zarr (v2) chunk directories: a .zarray header, a
+.zattrs file with the image metadata (the same properties set on the EE
+export) and one zlib-compressed file per chunk. Chunks are compressed and
+written by a thread pool as soon as the windows covering them have been
+classified, so a scene is never held in memory as a whole, and any subset
+can be read back by decompressing only the chunks it touches. The folders
+can be opened with zarr or xarray if available.
+"""
+
+import os
+import json
+import zlib
+import threading
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from common import NODATA
+
+
+class ChunkWriter:
+    """
+    Streaming writer of one class map.
+
+    path (str)       = output folder, e.g. '.../SVM_raw_T17RLM.zarr'.
+    shape (tuple)    = (rows, cols) of the map.
+    chunks (tuple)   = (rows, cols) of each chunk.
+    properties (dict)= image metadata (country, state, location, tile_id, date, classifier...).
+    transform (list) = optional affine geotransform [x0, dx, 0, y0, 0, dy] of the grid.
+    crs (str)        = coordinate reference system of the grid.
+    level (int)      = zlib compression level.
+    workers (int)    = threads compressing and writing chunks.
+
+    Usage:
+        with ChunkWriter(path, shape, properties=properties) as out:
+            for row, col, window in classifiedWindows:
+                out.write(row, col, window)
+    """
+
+    def __init__(self, path, shape, chunks=(512, 512), properties=None, transform=None,
+                 crs='EPSG:4326', level=5, workers=None):
+        self.path = path
+        self.shape = tuple(shape)
+        self.chunks = tuple(chunks)
+        self.level = level
+        os.makedirs(path, exist_ok=True)
+
+        header = {'zarr_format': 2, 'shape': list(self.shape), 'chunks': list(self.chunks),
+                  'dtype': '|u1', 'compressor': {'id': 'zlib', 'level': level},
+                  'fill_value': NODATA, 'order': 'C', 'filters': None,
+                  'dimension_separator': '.'}
+        attrs = dict(properties or {})
+        attrs['crs'] = crs
+        if transform is not None:
+            attrs['transform'] = list(transform)
+        with open(os.path.join(path, '.zarray'), 'w') as f:
+            json.dump(header, f, indent=1)
+        with open(os.path.join(path, '.zattrs'), 'w') as f:
+            json.dump(attrs, f, indent=1)
+
+        ## Chunks partially covered by the windows written so far
+        self._pending = {}
+        ## Chunks already sent to the pool
+        self._done = set()
+        self._lock = threading.Lock()
+        self._pool = ThreadPoolExecutor(max_workers=workers)
+        self._jobs = []
+
+    def _chunkSize(self, i, j):
+        return (min(self.chunks[0], self.shape[0] - i * self.chunks[0]),
+                min(self.chunks[1], self.shape[1] - j * self.chunks[1]))
+
+    def _save(self, key, block):
+        ## Chunks with no classified pixel are left out (read back as NODATA)
+        if (block == NODATA).all():
+            return
+        name = os.path.join(self.path, str(key[0])+'.'+str(key[1]))
+        with open(name, 'wb') as f:
+            f.write(zlib.compress(block.tobytes(), self.level))
+
+    # =========================================================================
+    # Add a classified window. Windows may have any size and may overlap (the
+    # last write wins); every chunk is sent to the pool once all its pixels
+    # have been written. Writing to a chunk already sent raises ValueError.
+    # row, col = position of the upper-left pixel of the window in the map.
+    # window = uint8 array (rows x cols) of classes, NODATA where masked.
+    # =========================================================================
+    def write(self, row, col, window):
+        window = np.asarray(window, dtype=np.uint8)
+        cr, cc = self.chunks
+        rows, cols = window.shape
+        for i in range(row // cr, (row + rows - 1) // cr + 1):
+            for j in range(col // cc, (col + cols - 1) // cc + 1):
+                r0, c0 = max(row, i * cr), max(col, j * cc)
+                r1, c1 = min(row + rows, (i + 1) * cr), min(col + cols, (j + 1) * cc)
+                with self._lock:
+                    if (i, j) in self._done:
+                        raise ValueError('Chunk '+str((i, j))+' of '+self.path+' already written')
+                    block, covered = self._pending.get((i, j), (None, None))
+                    if block is None:
+                        ## Edge chunks are stored full size, padded with NODATA
+                        block = np.full(self.chunks, NODATA, dtype=np.uint8)
+                        ## Pixels written so far (padding of edge chunks counts as written)
+                        h, w = self._chunkSize(i, j)
+                        covered = np.ones(self.chunks, dtype=bool)
+                        covered[:h, :w] = False
+                    inChunk = (slice(r0 - i * cr, r1 - i * cr), slice(c0 - j * cc, c1 - j * cc))
+                    block[inChunk] = window[r0 - row:r1 - row, c0 - col:c1 - col]
+                    covered[inChunk] = True
+                    if covered.all():
+                        self._pending.pop((i, j), None)
+                        self._done.add((i, j))
+                        self._jobs.append(self._pool.submit(self._save, (i, j), block))
+                    else:
+                        self._pending[(i, j)] = (block, covered)
+
+    ## Write the chunks still incomplete and wait for all of them.
+    def close(self):
+        with self._lock:
+            for key, (block, covered) in self._pending.items():
+                self._done.add(key)
+                self._jobs.append(self._pool.submit(self._save, key, block))
+            self._pending = {}
+        for job in self._jobs:
+            job.result()
+        self._pool.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+# =============================================================================
+# Function to read a subset of a class map written by ChunkWriter.
+
+## Usage:
+# path = folder of the map.
+# rows, cols = slices of the subset (default: the whole map).
+
+## Output:
+# array (uint8) of the subset and the dictionary of image metadata.
+# =============================================================================
+def readWindow(path, rows=slice(None), cols=slice(None)):
+    with open(os.path.join(path, '.zarray')) as f:
+        header = json.load(f)
+    with open(os.path.join(path, '.zattrs')) as f:
+        attrs = json.load(f)
+    shape = header['shape']
+    cr, cc = header['chunks']
+    r0, r1, _ = rows.indices(shape[0])
+    c0, c1, _ = cols.indices(shape[1])
+
+    out = np.full((r1 - r0, c1 - c0), header['fill_value'], dtype=np.uint8)
+    for i in range(r0 // cr, (r1 - 1) // cr + 1):
+        for j in range(c0 // cc, (c1 - 1) // cc + 1):
+            name = os.path.join(path, str(i)+'.'+str(j))
+            if not os.path.exists(name):
+                continue
+            with open(name, 'rb') as f:
+                block = np.frombuffer(zlib.decompress(f.read()), dtype=np.uint8).reshape(cr, cc)
+            a0, a1 = max(r0, i * cr), min(r1, (i + 1) * cr)
+            b0, b1 = max(c0, j * cc), min(c1, (j + 1) * cc)
+            out[a0 - r0:a1 - r0, b0 - c0:b1 - c0] = block[a0 - i * cr:a1 - i * cr, b0 - j * cc:b1 - j * cc]
+    return out, attrs
+
+###############################################################################
@@ -11,7 +11,7 @@ import os
 import sys
 sys.path.append(os.path.join(os.path.dirname(os.getcwd()),'bin'))
 import datetime
-from functions import CloudScore6S,landMaskFunction,div
+from functions import CloudScore6S,landMaskFunction,shallowTurbidityMask,div
 import geemap
 from IPython.display import display, Image
 
@@ -97,54 +97,8 @@ bathyMask = landMask##.clip(bathyVector) ##Using the NOAA dataset: bathyVector
 ## turbid waters, but sometimes may indicate shallow seagrass banks. So the below algorithm try to separate shallow seagrass
 ## from turbidity.
 
-## Set parameter values
-if 'Sentinel' in imageSat:
-    red_band = 'B4' #Red seems work better in this case than B5.
-    red_thr_inf = 0.025
-    red_thr_sup = 0.2
-    green_band = 'B3'
-    green_thr = 0.15
-    blue_band = 'B2'
-    blue_thr = 0.11
-elif 'Landsat8' in imageSat:
-    red_band = 'B4'
-    red_thr_inf = 0.025
-    red_thr_sup = 0.2
-    green_band = 'B3'
-    green_thr = 0.15
-    blue_band = 'B2'
-    blue_thr = 0.11
-else:
-    red_band = 'B3'
-    red_thr_inf = 0.03 #Landsat5/7 are less sensitive
-    red_thr_sup = 0.2
-    green_band = 'B2'
-    green_thr = 0.15
-    blue_band = 'B1'
-    blue_thr = 0.11
-
-## Select the red band
-selectRedBand = bathyMask.select('B4')
-
-## Identify turbid areas first (pixel values higher than the threshold)
-turbidMask = selectRedBand.gt(red_thr_inf)
-
-## Apply thresholds on red, green and blue bands
-maskRed = selectRedBand.gt(red_thr_inf).And(selectRedBand.lt(red_thr_sup))
-imageMaskRed = bathyMask.mask(maskRed)
-maskGreen = imageMaskRed.select(green_band).lt(green_thr)
-imageMaskGreen = imageMaskRed.mask(maskGreen)
-maskBlue = imageMaskGreen.select(blue_band).lt(blue_thr) ##Shallow seagrass
-
-## Final mask (excluding seagrass/including turbid water)
-turbidImage = bathyMask.mask(turbidMask) ## Turbidity
-seagrassImage = bathyMask.mask(maskBlue).mask().Not() ## Shallow seagrass (inverse mask)
-excludeSeagrass = turbidImage.updateMask(seagrassImage) ## Turbidity minus shallow seagrass
-finalMaskImage = bathyMask.mask(excludeSeagrass)
-finalMask = finalMaskImage.mask().Not()
-
-## Final Image
-finalImage = bathyMask.updateMask(finalMask)
+## Final Image (turbidity masked, shallow seagrass kept)
+finalImage = shallowTurbidityMask(bathyMask, imageSat)
 
 
 